@@ -0,0 +1,428 @@
+# Index advisor for the star schema: collects the analytics statements that actually run, from
+# pg_stat_statements, PostgreSQL logs, .sql files or `%sql` notebook cells, replays them through
+# EXPLAIN, proposes an index for every sequential scan of a star table they do, and measures each
+# proposal on a benchmark database. The approved proposals are written to ADVISED_INDEXES_FILE,
+# which create_tables.py applies along with its own indexes.
+import os
+import re
+import json
+import time
+import argparse
+import datetime
+import psycopg2
+from sql_queries import advisor_statement_stats, server_version_select, advisor_columns_select, \
+                        advisor_distinct_values, advisor_explain, advisor_explain_generic, advisor_explain_analyze, \
+                        advisor_index_size
+
+STAR_TABLES = ('songplays', 'users', 'songs', 'artists', 'time')
+
+# where `advisor.py advise` writes its proposals and `advisor.py approve` the approved DDL
+ADVICE_FILE = 'index_advice.json'
+ADVISED_INDEXES_FILE = 'advised_indexes.sql'
+
+# columns whose values follow the load order, so that a BRIN index is enough for ranges on them
+BRIN_COLUMNS = {'songplays': ('start_time',), 'time': ('start_time',)}
+
+# a column with at most this many distinct values is filtered on with a partial index
+PARTIAL_MAX_DISTINCT = 10
+
+# a scan outputting at most this many columns gets them included in its index
+COVERING_MAX_COLUMNS = 4
+
+STAR_TABLE_PATTERN = re.compile(r'\b({})\b'.format('|'.join(STAR_TABLES)), re.IGNORECASE)
+# the statements of a server log with log_min_duration_statement or log_statement
+LOG_STATEMENT_PATTERN = re.compile(r'(?:statement|execute [^:]*):\s*(.*)$')
+# 'literal'::type, so that casts and literals do not pass for columns
+LITERAL_PATTERN = re.compile(r"'(?:[^']|'')*'")
+CAST_PATTERN = re.compile(r'::(?:"[^"]+"|[a-z_]+(?: (?:without|with) time zone| varying| precision)?)(?:\[\])?')
+# the values a partial index predicate can be written with
+CONSTANT_PATTERN = re.compile(r"'(?:[^']|'')*'|-?\d+(?:\.\d+)?")
+PREDICATE_PATTERN = re.compile(r'^(?:\w+\.)?(\w+)\s*(=|<>|<=|>=|<|>|~~|IS NOT NULL|IS NULL)\s*(.*)$')
+
+
+def advised_index_queries(path=ADVISED_INDEXES_FILE):
+    """
+    Returns the approved CREATE INDEX statements of `path`, or none if it does not exist.
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        text = '\n'.join(line for line in f if not line.lstrip().startswith('--'))
+    return [statement.strip() for statement in text.split(';') if statement.strip()]
+
+
+def is_star_query(query):
+    """
+    Returns whether `query` is a SELECT (or WITH) statement reading one of the star tables.
+    """
+    return bool(re.match(r'\s*(select|with)\b', query, re.IGNORECASE)) and bool(STAR_TABLE_PATTERN.search(query))
+
+
+def statements_from_stats(cur, conn, limit=50):
+    """
+    Returns the star schema statements of pg_stat_statements that took the most time, or none
+    if the extension is not installed.
+    """
+    try:
+        cur.execute(advisor_statement_stats, (limit,))
+    except psycopg2.Error as e:
+        conn.rollback()
+        print('pg_stat_statements is not available: {}'.format(str(e).strip()))
+        return []
+    return [{'query': query, 'calls': calls, 'total_ms': total_ms, 'source': 'pg_stat_statements'}
+            for query, calls, total_ms in cur.fetchall() if is_star_query(query)]
+
+
+def statements_from_file(path):
+    """
+    Returns the star schema statements of a query log: a notebook (the `%sql` lines and `%%sql`
+    cells), a PostgreSQL server log (the `statement:` entries and their continuation lines) or a
+    file of SQL statements separated by semicolons.
+    """
+    with open(path) as f:
+        text = f.read()
+
+    if path.endswith('.ipynb'):
+        queries = []
+        for cell in json.loads(text)['cells']:
+            source = ''.join(cell['source']) if cell['cell_type'] == 'code' else ''
+            if source.startswith('%%sql'):
+                queries += ''.join(source.split('\n', 1)[1:]).split(';')
+            else:
+                queries += [line[len('%sql'):] for line in source.splitlines() if line.startswith('%sql ')]
+    elif LOG_STATEMENT_PATTERN.search(text) and re.search(r'\b(LOG|STATEMENT):', text):
+        queries = []
+        for line in text.splitlines():
+            match = LOG_STATEMENT_PATTERN.search(line) if re.search(r'\b(LOG|STATEMENT):', line) else None
+            if match:
+                queries.append(match.group(1))
+            elif queries and line.startswith('\t'):
+                queries[-1] += ' ' + line.strip()
+    else:
+        queries = text.split(';')
+
+    statements = []
+    for query in queries:
+        query = ' '.join(query.split()).rstrip(';')
+        if is_star_query(query):
+            statements.append({'query': query, 'calls': 1, 'total_ms': None, 'source': path})
+    return statements
+
+
+def is_parameterized(query):
+    """
+    Returns whether `query` has $n parameters, as the statements of pg_stat_statements do.
+    """
+    return bool(re.search(r'\$\d+', query))
+
+
+def explain(cur, conn, query, server_version):
+    """
+    Returns the plan of `query`, or None if it cannot be planned: statements with parameters
+    need PostgreSQL 16's GENERIC_PLAN.
+    """
+    if is_parameterized(query):
+        if server_version < 160000:
+            return None
+        template = advisor_explain_generic
+    else:
+        template = advisor_explain
+    try:
+        cur.execute(template.format(query))
+        return cur.fetchone()[0][0]['Plan']
+    except psycopg2.Error as e:
+        conn.rollback()
+        print('cannot explain {}: {}'.format(query[:60], str(e).strip()))
+        return None
+
+
+def scans(plan, parent=None):
+    """
+    Yields (scan node, parent node) for every sequential scan of a star table in `plan`. The
+    monthly partitions of songplays count as songplays.
+    """
+    if plan.get('Node Type') == 'Seq Scan':
+        relation = re.sub(r'_\d{4}_\d{2}$', '', plan.get('Relation Name', ''))
+        if relation in STAR_TABLES:
+            yield dict(plan, **{'Relation Name': relation}), parent or {}
+    # the scan below a Hash node is joined by the Hash Join above it
+    for child in plan.get('Plans', ()):
+        yield from scans(child, parent if plan.get('Node Type') == 'Hash' else plan)
+
+
+def split_predicates(condition):
+    """
+    Splits an EXPLAIN condition into its ANDed (column, operator, value) predicates, without
+    the casts, parentheses and table aliases EXPLAIN adds. Predicates that are not a column
+    compared to something, such as a function of a column, are left out.
+    """
+    if not condition:
+        return []
+    literals = LITERAL_PATTERN.findall(condition)
+    # number the literals, so that they can be put back once the casts and parentheses are gone
+    numbers = iter(range(len(literals)))
+    masked = LITERAL_PATTERN.sub(lambda match: '\x00{}\x00'.format(next(numbers)), condition)
+    masked = CAST_PATTERN.sub('', masked)
+
+    predicates = []
+    for part in re.split(r'\s+AND\s+', masked):
+        if re.search(r'\w\(', part):
+            continue
+        match = PREDICATE_PATTERN.match(part.replace('(', '').replace(')', '').strip())
+        if match:
+            column, operator, value = match.groups()
+            predicates.append((column, operator,
+                               re.sub('\x00(\\d+)\x00', lambda number: literals[int(number.group(1))], value)))
+    return predicates
+
+
+def join_columns(scan, parent, columns):
+    """
+    Returns the columns of the scanned table in the join condition of its parent node.
+    """
+    alias = scan.get('Alias', scan['Relation Name'])
+    condition = ' '.join(parent.get(key, '') for key in ('Hash Cond', 'Merge Cond', 'Join Filter'))
+    found = re.findall(r'\b{}\.(\w+)'.format(re.escape(alias)), condition)
+    return [column for column in dict.fromkeys(found) if column in columns]
+
+
+def output_columns(scan, columns):
+    """
+    Returns the columns of the scanned table the scan outputs (EXPLAIN VERBOSE).
+    """
+    found = [re.sub(r'^\w+\.', '', output) for output in scan.get('Output', ())]
+    return [column for column in found if column in columns]
+
+
+def index_name(table, columns, kind):
+    """
+    Returns the name of a proposed index, within PostgreSQL's 63 characters.
+    """
+    return 'advised_{}_{}_{}'.format(table, '_'.join(columns), kind)[:63]
+
+
+def propose(scan, parent, columns, distinct):
+    """
+    Returns the index proposal ({'table', 'kind', 'name', 'ddl', 'reason'}) for one sequential scan, or
+    None if nothing it filters or joins on could use an index:
+
+    - a BRIN index for a range on a column that follows the load order
+    - a partial index for an IS [NOT] NULL test or an equality on a column of few values
+    - a btree index on the equality, then range, then join columns otherwise, covering the
+      output columns if there are few of them
+    """
+    table = scan['Relation Name']
+    predicates = [p for p in split_predicates(scan.get('Filter')) if p[0] in columns[table]]
+    equalities = [column for column, operator, value in predicates if operator == '=']
+    ranges = [column for column, operator, value in predicates if operator in ('<', '<=', '>', '>=')]
+    joins = join_columns(scan, parent, columns[table])
+
+    partial = [(column, operator, value) for column, operator, value in predicates
+               if operator in ('IS NULL', 'IS NOT NULL')
+               or (operator == '=' and CONSTANT_PATTERN.fullmatch(value)
+                   and 0 < distinct.get((table, column), PARTIAL_MAX_DISTINCT + 1) <= PARTIAL_MAX_DISTINCT)]
+    if partial:
+        partial_columns = [column for column, operator, value in partial]
+        keys = [column for column in dict.fromkeys(equalities + ranges + joins) if column not in partial_columns]
+        keys = keys or partial_columns[:1]
+        where = ' AND '.join('{} {} {}'.format(column, operator, value).strip() for column, operator, value in partial)
+        name = index_name(table, keys, 'partial')
+        return {'table': table, 'kind': 'partial', 'name': name,
+                'ddl': 'CREATE INDEX IF NOT EXISTS {} ON {} ({}) WHERE {}'.format(name, table, ', '.join(keys), where),
+                'reason': 'sequential scan of {} filtering on {}'.format(table, where)}
+
+    brin = [column for column in ranges if column in BRIN_COLUMNS.get(table, ())]
+    if brin and not equalities:
+        name = index_name(table, brin[:1], 'brin')
+        return {'table': table, 'kind': 'brin', 'name': name,
+                'ddl': 'CREATE INDEX IF NOT EXISTS {} ON {} USING brin ({})'.format(name, table, brin[0]),
+                'reason': 'sequential scan of {} for a range of {}'.format(table, brin[0])}
+
+    keys = list(dict.fromkeys(equalities + ranges + joins))
+    if not keys:
+        return None
+    include = [column for column in output_columns(scan, columns[table]) if column not in keys]
+    kind = 'covering' if include and len(keys) + len(include) <= COVERING_MAX_COLUMNS else 'btree'
+    name = index_name(table, keys, kind)
+    ddl = 'CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(name, table, ', '.join(keys))
+    if kind == 'covering':
+        ddl += ' INCLUDE ({})'.format(', '.join(include))
+    return {'table': table, 'kind': kind, 'name': name, 'ddl': ddl,
+            'reason': 'sequential scan of {} {} {}'.format(
+                table, 'filtering on' if equalities or ranges else 'joining on', ', '.join(keys))}
+
+
+def execution_ms(cur, query, repeats):
+    """
+    Returns the fastest server-side execution time of `query` over `repeats` EXPLAIN ANALYZE runs.
+    """
+    best = None
+    for _ in range(repeats):
+        cur.execute(advisor_explain_analyze.format(query))
+        ms = cur.fetchone()[0][0]['Execution Time']
+        best = ms if best is None else min(best, ms)
+    return best
+
+
+def measure(cur, conn, proposal, repeats=3):
+    """
+    Times the statements behind `proposal` before and after creating its index, in a
+    transaction that is rolled back, so the database is left as it was. Statements with
+    parameters cannot be run and are not timed.
+
+    Returns the proposal with the before and after milliseconds, the speedup and the index size.
+    """
+    queries = [query for query in proposal['queries'] if not is_parameterized(query)]
+    if not queries:
+        return dict(proposal, measured=False)
+    try:
+        before = sum(execution_ms(cur, query, repeats) for query in queries)
+        cur.execute(proposal['ddl'])
+        after = sum(execution_ms(cur, query, repeats) for query in queries)
+        cur.execute(advisor_index_size, (proposal['name'],))
+        size = cur.fetchone()[0]
+    except psycopg2.Error as e:
+        print('cannot measure {}: {}'.format(proposal['ddl'], str(e).strip()))
+        return dict(proposal, measured=False)
+    finally:
+        conn.rollback()
+    return dict(proposal, measured=True, before_ms=before, after_ms=after,
+                speedup=before / after if after else None, index_bytes=size)
+
+
+def advise(cur, conn, statements, repeats=3):
+    """
+    Explains every statement and returns one proposal per distinct index, with the statements
+    that would use it, measured on the database `cur` is connected to.
+    """
+    cur.execute(server_version_select)
+    server_version = cur.fetchone()[0]
+    cur.execute(advisor_columns_select, (list(STAR_TABLES),))
+    columns = {table: set() for table in STAR_TABLES}
+    for table, column in cur.fetchall():
+        columns[table].add(column)
+    cur.execute(advisor_distinct_values, (list(STAR_TABLES),))
+    distinct = {(table, column): n for table, column, n in cur.fetchall()}
+    conn.rollback()
+
+    proposals = {}
+    for statement in statements:
+        plan = explain(cur, conn, statement['query'], server_version)
+        if plan is None:
+            continue
+        for scan, parent in scans(plan):
+            proposal = propose(scan, parent, columns, distinct)
+            if proposal is None:
+                continue
+            proposal = proposals.setdefault(proposal['ddl'], dict(proposal, queries=[]))
+            if statement['query'] not in proposal['queries']:
+                proposal['queries'].append(statement['query'])
+
+    advice = []
+    for number, proposal in enumerate(proposals.values(), start=1):
+        advice.append(dict(measure(cur, conn, proposal, repeats), id=number))
+    return advice
+
+
+def print_advice(advice):
+    """
+    Prints the proposals with their timings.
+    """
+    for proposal in advice:
+        if proposal['measured']:
+            timing = '{:.2f}ms -> {:.2f}ms ({:.1f}x), {} kB'.format(
+                proposal['before_ms'], proposal['after_ms'], proposal['speedup'] or 0, proposal['index_bytes'] // 1024)
+        else:
+            timing = 'not measured'
+        print('{:>3} {:<9} {}'.format(proposal['id'], proposal['kind'], proposal['ddl']))
+        print('    {}; {} statement(s), {}'.format(proposal['reason'], len(proposal['queries']), timing))
+
+
+def approve(advice, ids=(), min_speedup=None, path=ADVISED_INDEXES_FILE):
+    """
+    Adds the proposals of `ids`, and the measured ones at least `min_speedup` times faster, to
+    the approved indexes of `path`.
+
+    Returns the statements added.
+    """
+    existing = advised_index_queries(path)
+    approved = [proposal for proposal in advice
+                if proposal['id'] in ids
+                or (min_speedup is not None and proposal['measured'] and (proposal['speedup'] or 0) >= min_speedup)]
+    added = [proposal for proposal in approved if proposal['ddl'] not in existing]
+    with open(path, 'a') as f:
+        for proposal in added:
+            f.write('-- {} ({})\n{};\n'.format(proposal['reason'], datetime.date.today().isoformat(), proposal['ddl']))
+    return [proposal['ddl'] for proposal in added]
+
+
+def parse_args():
+    """
+    Reads the command line options.
+    """
+    parser = argparse.ArgumentParser(description='Proposes indexes for the statements run against the star schema '
+                                                 'and records the approved ones for create_tables.py.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    advise_command = commands.add_parser('advise', help='collect, explain and measure')
+    advise_command.add_argument('--log', action='append', default=[], metavar='PATH',
+                                help='also read the statements of a notebook, server log or .sql file (repeatable)')
+    advise_command.add_argument('--no-stats', action='store_true',
+                                help='do not read the statements of pg_stat_statements')
+    advise_command.add_argument('--limit', type=int, default=50, metavar='N',
+                                help='read the N most time-consuming statements of pg_stat_statements (default: 50)')
+    advise_command.add_argument('--dsn', metavar='DSN',
+                                help='the benchmark database to explain and measure on (default: sparkifydb)')
+    advise_command.add_argument('--repeats', type=int, default=3, metavar='N',
+                                help='time every statement N times and keep the fastest (default: 3)')
+    advise_command.add_argument('--output', default=ADVICE_FILE, metavar='PATH',
+                                help='where to write the proposals (default: {})'.format(ADVICE_FILE))
+
+    approve_command = commands.add_parser('approve', help='record proposals for create_tables.py')
+    approve_command.add_argument('ids', type=int, nargs='*', metavar='ID', help='the proposals to approve')
+    approve_command.add_argument('--min-speedup', type=float, metavar='X',
+                                 help='also approve every measured proposal at least X times faster')
+    approve_command.add_argument('--advice', default=ADVICE_FILE, metavar='PATH',
+                                 help='the proposals to approve from (default: {})'.format(ADVICE_FILE))
+    approve_command.add_argument('--output', default=ADVISED_INDEXES_FILE, metavar='PATH',
+                                 help='the approved indexes (default: {})'.format(ADVISED_INDEXES_FILE))
+    return parser.parse_args()
+
+
+def main():
+    """
+    Runs the advise or approve command.
+    """
+    args = parse_args()
+    if args.command == 'approve':
+        with open(args.advice) as f:
+            advice = json.load(f)['proposals']
+        added = approve(advice, ids=args.ids, min_speedup=args.min_speedup, path=args.output)
+        print('{} indexes added to {}'.format(len(added), args.output))
+        for ddl in added:
+            print('  ' + ddl)
+        return
+
+    # etl imports pandas, so it is only loaded for the commands that connect
+    from etl import connect, SPARKIFY_DSN
+
+    conn = connect(args.dsn or SPARKIFY_DSN)
+    cur = conn.cursor()
+
+    statements = [] if args.no_stats else statements_from_stats(cur, conn, args.limit)
+    for path in args.log:
+        statements += statements_from_file(path)
+    print('{} statements collected'.format(len(statements)))
+
+    start = time.perf_counter()
+    advice = advise(cur, conn, statements, repeats=args.repeats)
+    conn.close()
+    print_advice(advice)
+    with open(args.output, 'w') as f:
+        json.dump({'statements': len(statements), 'seconds': time.perf_counter() - start, 'proposals': advice}, f,
+                  indent=2, default=str)
+    print('{} proposals written to {}; approve them with advisor.py approve'.format(len(advice), args.output))
+
+
+if __name__ == "__main__":
+    main()
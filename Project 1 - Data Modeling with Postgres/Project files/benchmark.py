@@ -0,0 +1,309 @@
+import os
+import sys
+import json
+import time
+import shlex
+import random
+import string
+import argparse
+import datetime
+import resource
+import subprocess
+
+# number of NextSong events of every named scale
+SCALES = {'10k': 10000, '100k': 100000, '1m': 1000000, '10m': 10000000}
+
+BENCHMARK_DIR = 'benchmark_data'
+RESULTS_FILE = 'benchmark_results.jsonl'
+
+# where etl.py and create_tables.py are, the benchmark runs them from the data directory
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# the pages of the non-NextSong events, about one in six events like in data/log_data
+OTHER_PAGES = ['Home', 'Home', 'Home', 'Login', 'Logout', 'Downgrade', 'Upgrade', 'About', 'Help', 'Settings']
+
+
+def parse_scale(scale):
+    """
+    Returns the number of events of a named scale (10k, 100k, 1m, 10m) or of a plain number.
+    """
+    return SCALES[scale.lower()] if scale.lower() in SCALES else int(scale)
+
+
+def random_id(rng, prefix):
+    """
+    Returns an id like the ones of the song dataset: a prefix and 16 upper case letters and digits.
+    """
+    return prefix + ''.join(rng.choices(string.ascii_uppercase + string.digits, k=16))
+
+
+def song_records(rng, num_songs):
+    """
+    Returns `num_songs` song records in the format of data/song_data, with about four songs
+    per artist.
+    """
+    artists = []
+    for i in range(max(1, num_songs // 4)):
+        located = rng.random() < 0.5
+        artists.append({'artist_id': random_id(rng, 'AR'),
+                        'artist_name': 'Artist {}'.format(i),
+                        'artist_location': 'City {}'.format(rng.randrange(500)) if located else '',
+                        'artist_latitude': round(rng.uniform(-90, 90), 5) if located else None,
+                        'artist_longitude': round(rng.uniform(-180, 180), 5) if located else None})
+
+    songs = []
+    for i in range(num_songs):
+        record = {'num_songs': 1}
+        record.update(rng.choice(artists))
+        record.update({'song_id': random_id(rng, 'SO'),
+                       'title': 'Song {}'.format(i),
+                       'duration': round(rng.uniform(60, 600), 5),
+                       'year': rng.choice([0, rng.randrange(1960, 2019)])})
+        songs.append(record)
+    return songs
+
+
+def user_records(rng, num_users):
+    """
+    Returns `num_users` users with the fields the log events repeat for them.
+    """
+    user_agents = ['"Mozilla/5.0 (Synthetic {}) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/{}.0 Safari/537.36"'.format(
+        i, 30 + i) for i in range(40)]
+    return [{'userId': str(i + 1),
+             'firstName': 'First{}'.format(i),
+             'lastName': 'Last{}'.format(i),
+             'gender': rng.choice('MF'),
+             'level': rng.choice(['free', 'paid']),
+             'location': 'Metro Area {}, ST'.format(rng.randrange(200)),
+             'userAgent': rng.choice(user_agents),
+             'registration': 1540000000000.0 + rng.randrange(10 ** 9)} for i in range(num_users)]
+
+
+def generate(root, num_events, events_per_file=1000, match_rate=0.2, seed=0):
+    """
+    Writes synthetic song and log files below `root`/data, in the song_data/A/B/C/*.json and
+    log_data/YYYY/MM/*.json layout of the sample data, with `num_events` NextSong events,
+    `events_per_file` of them per day, one song file per 100 events and `match_rate` of the
+    events playing one of the generated songs.
+
+    The data depends only on the arguments, so every run of a scale loads the same files.
+    Nothing is written if `root` already holds the data for the same arguments.
+    """
+    params = {'events': num_events, 'events_per_file': events_per_file, 'match_rate': match_rate, 'seed': seed}
+    params_file = os.path.join(root, 'generated.json')
+    if os.path.exists(params_file):
+        with open(params_file) as f:
+            if json.load(f) == params:
+                print('{} already holds {} events'.format(root, num_events))
+                return params
+        raise SystemExit('{} holds data generated with other arguments, remove it first'.format(root))
+
+    rng = random.Random(seed)
+    start = time.perf_counter()
+
+    songs = song_records(rng, max(1, num_events // 100))
+    for song in songs:
+        track_id = random_id(rng, 'TR')
+        song_dir = os.path.join(root, 'data', 'song_data', track_id[2], track_id[3], track_id[4])
+        os.makedirs(song_dir, exist_ok=True)
+        with open(os.path.join(song_dir, track_id + '.json'), 'w') as f:
+            json.dump(song, f)
+
+    users = user_records(rng, max(100, num_events // 500))
+    day = datetime.date(2018, 11, 1)
+    written = 0
+    num_log_files = 0
+    while written < num_events:
+        day_events = min(events_per_file, num_events - written)
+        log_dir = os.path.join(root, 'data', 'log_data', '{:%Y}'.format(day), '{:%m}'.format(day))
+        os.makedirs(log_dir, exist_ok=True)
+
+        day_start = (day - datetime.date(1970, 1, 1)).days * 86400000
+        timestamps = sorted(day_start + rng.randrange(86400000) for _ in range(day_events))
+        with open(os.path.join(log_dir, '{:%Y-%m-%d}-events.json'.format(day)), 'w') as f:
+            for item, ts in enumerate(timestamps):
+                user = rng.choice(users)
+                # users now and then up- or downgrade
+                if rng.random() < 0.001:
+                    user['level'] = 'paid' if user['level'] == 'free' else 'free'
+                event = {'auth': 'Logged In', 'itemInSession': item, 'method': 'PUT', 'page': 'NextSong',
+                         'sessionId': (day.toordinal() * 1000 + int(user['userId'])) % 100000, 'status': 200, 'ts': ts}
+                event.update(user)
+                if rng.random() < match_rate:
+                    song = rng.choice(songs)
+                    event.update({'artist': song['artist_name'], 'song': song['title'], 'length': song['duration']})
+                else:
+                    event.update({'artist': 'Unknown Artist {}'.format(rng.randrange(10000)),
+                                  'song': 'Unknown Song {}'.format(rng.randrange(100000)),
+                                  'length': round(rng.uniform(60, 600), 5)})
+                f.write(json.dumps(event) + '\n')
+
+                if rng.random() < 0.2:
+                    other = dict(event, page=rng.choice(OTHER_PAGES), method='GET', artist=None, song=None, length=None)
+                    f.write(json.dumps(other) + '\n')
+
+        written += day_events
+        num_log_files += 1
+        day += datetime.timedelta(days=1)
+
+    with open(params_file, 'w') as f:
+        json.dump(params, f)
+    print('{} song files and {} log files with {} events written to {} in {:.1f}s'.format(
+        len(songs), num_log_files, num_events, root, time.perf_counter() - start))
+    return params
+
+
+def git_commit():
+    """
+    Returns the commit the benchmark runs, or None outside of a git checkout.
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=SCRIPT_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_etl(root, etl_args=(), create_args=()):
+    """
+    Empties sparkifydb with create_tables.py --reset and `create_args` and loads the data below `root` with
+    etl.py and `etl_args`, and returns the files/sec, rows/sec and per-table load times of every
+    phase (from the metrics etl.py writes), the elapsed time and the peak RSS of etl.py.
+    """
+    metrics_prefix = os.path.join(os.path.abspath(root), 'etl_metrics')
+    subprocess.check_call([sys.executable, os.path.join(SCRIPT_DIR, 'create_tables.py'), '--reset'] + list(create_args),
+                          cwd=root)
+
+    start = time.perf_counter()
+    subprocess.check_call([sys.executable, os.path.join(SCRIPT_DIR, 'etl.py'), '--metrics', metrics_prefix]
+                          + list(etl_args), cwd=root)
+    seconds = time.perf_counter() - start
+    # the largest resident set of any child so far, which is etl.py (or one of its workers)
+    # since create_tables.py stays far smaller; kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    with open(metrics_prefix + '.json') as f:
+        recorded = json.load(f)
+
+    phases = {}
+    for phase, phase_seconds in recorded['run']['phase_seconds'].items():
+        phase_metrics = recorded['phases'].get(phase, {})
+        files = sum(phase_metrics.get('files', {}).values())
+        rows = sum(phase_metrics.get('rows_attempted', {}).values())
+        phases[phase] = {'files': files, 'rows': rows, 'seconds': phase_seconds,
+                         'files_per_sec': files / max(phase_seconds, 1e-9),
+                         'rows_per_sec': rows / max(phase_seconds, 1e-9),
+                         'table_seconds': phase_metrics.get('table_seconds', {})}
+
+    rows = sum(phase['rows'] for phase in phases.values())
+    return {'seconds': seconds, 'rows': rows, 'rows_per_sec': rows / max(seconds, 1e-9),
+            'files': sum(phase['files'] for phase in phases.values()),
+            'peak_rss_mb': peak_rss / 1024, 'phases': phases}
+
+
+def print_result(result):
+    """
+    Prints the numbers of one benchmark run.
+    """
+    print('{} events ({}), {}: {:.1f}s, {:.0f} rows/sec, peak RSS {:.0f} MB'.format(
+        result['events'], result['scale'], ' '.join(result['etl_args']) or 'default options',
+        result['seconds'], result['rows_per_sec'], result['peak_rss_mb']))
+    for phase, stats in result['phases'].items():
+        print('  {:<6} {:>8} files {:>9.1f} files/sec {:>10} rows {:>9.0f} rows/sec   {}'.format(
+            phase, stats['files'], stats['files_per_sec'], stats['rows'], stats['rows_per_sec'],
+            ', '.join('{} {:.2f}s'.format(table, seconds) for table, seconds in sorted(stats['table_seconds'].items()))))
+
+
+def compare(results_file=RESULTS_FILE, scale=None, last=10):
+    """
+    Prints the last `last` stored runs, of one scale if given, oldest first, so the effect of
+    a change shows up run over run.
+    """
+    if not os.path.exists(results_file):
+        print('no benchmark results in {}'.format(results_file))
+        return
+    with open(results_file) as f:
+        results = [json.loads(line) for line in f if line.strip()]
+    if scale is not None:
+        results = [result for result in results if result['events'] == parse_scale(scale)]
+
+    print('{:<20} {:<8} {:>9} {:>9} {:>10} {:>8}  {}'.format(
+        'run at', 'commit', 'events', 'seconds', 'rows/sec', 'RSS MB', 'etl options'))
+    for result in results[-last:]:
+        print('{:<20} {:<8} {:>9} {:>9.1f} {:>10.0f} {:>8.0f}  {}'.format(
+            result['run_at'], result['commit'] or '-', result['events'], result['seconds'],
+            result['rows_per_sec'], result['peak_rss_mb'], ' '.join(result['etl_args'])))
+
+
+def parse_args():
+    """
+    Reads the command line options.
+    """
+    parser = argparse.ArgumentParser(description='Benchmarks etl.py on synthetic data of a given scale.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    for name, help_text in (('generate', 'only write the synthetic data'),
+                            ('run', 'write the synthetic data if needed, load it and store the result')):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument('--scale', default='10k',
+                             help='number of NextSong events: 10k, 100k, 1m, 10m or a number (default: 10k)')
+        command.add_argument('--events-per-file', type=int, default=1000, metavar='N',
+                             help='NextSong events per daily log file (default: 1000)')
+        command.add_argument('--match-rate', type=float, default=0.2,
+                             help='share of the events that play a generated song (default: 0.2)')
+        command.add_argument('--seed', type=int, default=0)
+        command.add_argument('--dir', metavar='PATH',
+                             help='where to write the data (default: {}/<events>)'.format(BENCHMARK_DIR))
+    run = commands.choices['run']
+    # the options are given with an = (--etl-args="--copy"), since argparse takes a separate
+    # value that starts with a dash for an option of its own
+    run.add_argument('--etl-args', default='', metavar='ARGS',
+                     help='options passed on to etl.py, for example --etl-args="--copy --workers 4"')
+    run.add_argument('--create-args', default='', metavar='ARGS',
+                     help='options passed on to create_tables.py, for example --create-args="--encoded"; '
+                          '--bulk given to either script is passed on to the other as well')
+    run.add_argument('--results', default=RESULTS_FILE, metavar='PATH',
+                     help='the file the results are appended to (default: {})'.format(RESULTS_FILE))
+
+    show = commands.add_parser('compare', help='print the stored results')
+    show.add_argument('--scale', help='only the runs of this scale')
+    show.add_argument('--last', type=int, default=10, metavar='N', help='the last N runs (default: 10)')
+    show.add_argument('--results', default=RESULTS_FILE, metavar='PATH')
+    return parser.parse_args()
+
+
+def main():
+    """
+    Generates the data of a scale, runs the ETL on it through a fresh sparkifydb and appends
+    the result to the results file, or prints the stored results.
+    """
+    args = parse_args()
+    if args.command == 'compare':
+        compare(args.results, args.scale, args.last)
+        return
+
+    num_events = parse_scale(args.scale)
+    root = args.dir or os.path.join(BENCHMARK_DIR, str(num_events))
+    params = generate(root, num_events, args.events_per_file, args.match_rate, args.seed)
+    if args.command == 'generate':
+        return
+
+    etl_args = shlex.split(args.etl_args)
+    create_args = shlex.split(args.create_args)
+    # etl.py --bulk loads into the tables of create_tables.py --bulk, and only into those
+    if '--bulk' in create_args and '--bulk' not in etl_args:
+        etl_args.append('--bulk')
+    elif '--bulk' in etl_args and '--bulk' not in create_args:
+        create_args.append('--bulk')
+    result = {'run_at': datetime.datetime.now().isoformat(timespec='seconds'), 'commit': git_commit(),
+              'scale': args.scale, 'etl_args': etl_args, 'create_args': create_args, 'data': params}
+    result.update(run_etl(root, etl_args, create_args))
+    result['events'] = num_events
+
+    with open(args.results, 'a') as f:
+        f.write(json.dumps(result) + '\n')
+    print_result(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+import time
+import rollups
+from advisor import advised_index_queries
+from sql_queries import table_primary_keys, table_not_null_columns, create_index_queries, bulk_table_persistence, \
+                        bulk_primary_key_check, bulk_dedupe, bulk_primary_key_add, bulk_not_null_set, bulk_set_logged, bulk_analyze
+
+
+def finish_bulk_load(cur, conn):
+    """
+    Turns the tables created by `create_tables.py --bulk` into the regular schema once the
+    data is loaded:
+
+    - removes the duplicate keys ON CONFLICT DO NOTHING could not catch without a primary key
+    - adds the primary keys and NOT NULL constraints
+    - creates the indexes, those approved with advisor.py included
+    - switches the tables to logged
+    - runs ANALYZE
+    - rebuilds the rollup tables, which counted the duplicate songplays
+
+    Tables that are already logged are left alone, so it is safe to run twice.
+    """
+    cur.execute(bulk_table_persistence, (list(table_primary_keys),))
+    tables = [row[0] for row in cur.fetchall()]
+    if not tables:
+        print('no unlogged tables to finish')
+        return
+
+    start = time.perf_counter()
+    for table in tables:
+        cur.execute(bulk_primary_key_check, (table,))
+        if not cur.fetchone():
+            key = table_primary_keys[table]
+            cur.execute(bulk_dedupe.format(table, ' AND '.join('a.{0} = b.{0}'.format(column) for column in key)))
+            print('{}: {} duplicate rows removed'.format(table, cur.rowcount))
+            cur.execute(bulk_primary_key_add.format(table, ', '.join(key)))
+        for column in table_not_null_columns.get(table, ()):
+            cur.execute(bulk_not_null_set.format(table, column))
+        conn.commit()
+
+    for query in create_index_queries + advised_index_queries():
+        cur.execute(query)
+    conn.commit()
+
+    for table in tables:
+        cur.execute(bulk_set_logged.format(table))
+        cur.execute(bulk_analyze.format(table))
+        conn.commit()
+
+    if 'songplays' in tables and rollups.enabled(cur):
+        rollups.rebuild(cur, conn)
+
+    print('constraints, indexes, logging and statistics of {} finished in {:.2f}s'.format(
+        ', '.join(tables), time.perf_counter() - start))
@@ -0,0 +1,108 @@
+import json
+import time
+import random
+import argparse
+import datetime
+import encoding
+import partitions
+from etl import connect, get_files, song_table_rows, log_table_rows
+from loaders import LOADERS, LOADER_CHOICE_FILE
+from song_index import SongIndex
+
+
+def sample_files(filepath, num_files, seed=0):
+    """
+    Returns the same random sample of `num_files` files of `filepath` on every run.
+    """
+    all_files = get_files(filepath)
+    return sorted(random.Random(seed).sample(all_files, min(num_files, len(all_files))))
+
+
+def time_loader(cur, conn, loader, table, rows, repeats):
+    """
+    Loads `rows` into `table` with `loader` `repeats` times, each in a transaction that is
+    rolled back, and returns the fastest time. The songplays rows of songplays_encoded are
+    encoded in each transaction, outside of the timing.
+    """
+    best = None
+    for _ in range(repeats):
+        load_rows = rows
+        if table == 'songplays':
+            partitions.ensure_songplay_partitions(cur, [row[1] for row in rows])
+        elif table == 'songplays_encoded':
+            load_rows = encoding.encode_songplay_rows(cur, rows)
+        start = time.perf_counter()
+        loader.load(cur, table, load_rows)
+        seconds = time.perf_counter() - start
+        conn.rollback()
+        # the rollback dropped any partition and dictionary value added above
+        partitions.created_months.clear()
+        encoding.forget()
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def calibrate(cur, conn, num_files=20, repeats=3):
+    """
+    Runs every loader strategy of loaders.py against the rows of a sample of the song and log
+    files and returns the fastest strategy of every table along with all the timings.
+    """
+    song_files = sample_files('data/song_data', num_files)
+    log_files = sample_files('data/log_data', num_files)
+
+    song_index = SongIndex.from_database(cur)
+    table_rows = song_table_rows(song_files)
+    table_rows.update(log_table_rows(cur, log_files, song_index))
+    # songplays is a view on a create_tables.py --encoded database, the log files load songplays_encoded
+    if encoding.encoded(cur):
+        table_rows['songplays_encoded'] = table_rows.pop('songplays')
+    conn.rollback()
+
+    timings = {}
+    for table, rows in table_rows.items():
+        timings[table] = {}
+        for name, loader in sorted(LOADERS.items()):
+            seconds = time_loader(cur, conn, loader(), table, rows, repeats)
+            timings[table][name] = {'rows': len(rows), 'seconds': seconds,
+                                    'rows_per_second': len(rows) / seconds if seconds else None}
+            print('{:<10} {:<12} {:>6} rows in {:8.4f}s'.format(table, name, len(rows), seconds))
+
+    choice = {table: min(results, key=lambda name: results[name]['seconds']) for table, results in timings.items()}
+    return {'choice': choice, 'timings': timings, 'song_files': len(song_files), 'log_files': len(log_files),
+            'calibrated_at': datetime.datetime.now().isoformat(timespec='seconds')}
+
+
+def parse_args():
+    """
+    Reads the command line options.
+    """
+    parser = argparse.ArgumentParser(description='Times every loader strategy on a sample of data/ and records '
+                                                 'the fastest one per table for etl.py --loader auto.')
+    parser.add_argument('--files', type=int, default=20, metavar='N',
+                        help='number of song files and of log files to sample (default: 20)')
+    parser.add_argument('--repeats', type=int, default=3, metavar='N',
+                        help='time every strategy N times and keep the fastest (default: 3)')
+    parser.add_argument('--output', default=LOADER_CHOICE_FILE, metavar='PATH',
+                        help='where to write the choice (default: {})'.format(LOADER_CHOICE_FILE))
+    return parser.parse_args()
+
+
+def main():
+    """
+    Calibrates the loader strategies on sparkifydb. Nothing is left in the database: every
+    timed load is rolled back.
+    """
+    args = parse_args()
+    conn = connect()
+    cur = conn.cursor()
+
+    result = calibrate(cur, conn, num_files=args.files, repeats=args.repeats)
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print('fastest: ' + ', '.join('{} {}'.format(table, name) for table, name in result['choice'].items()))
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
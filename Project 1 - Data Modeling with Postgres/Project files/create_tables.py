@@ -1,27 +1,46 @@
+import time
+import hashlib
+import argparse
 import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+from sql_queries import create_table_queries, drop_table_queries, create_index_queries, \
+                        songplay_table_create, songplay_table_create_partitioned, create_table_queries_bulk, \
+                        location_table_create, user_agent_table_create, songplay_encoded_table_create, \
+                        songplay_view_create, schema_version_table_create, schema_version_check, \
+                        schema_version_select, schema_version_insert, database_exists, database_drop, database_create, \
+                        reset_tables_select, reset_truncate
+from advisor import advised_index_queries
 
+# the empty database create_tables.py --reset clones sparkifydb from when its schema changed
+TEMPLATE_DATABASE = 'sparkifydb_template'
 
-def create_database():
+
+def connect(dbname):
+    """
+    Connects to database `dbname` of the local server.
+    """
+    return psycopg2.connect("host=127.0.0.1 dbname={} user=student password=student".format(dbname))
+
+
+def create_database(dbname='sparkifydb', template='template0'):
     """
-    - Creates and connects to the sparkifydb
+    - Creates and connects to the sparkifydb (or `dbname`), as a copy of `template`
     - Returns the connection and cursor to sparkifydb
     """
     
     # connect to default database
-    conn = psycopg2.connect("host=127.0.0.1 dbname=studentdb user=student password=student")
+    conn = connect('studentdb')
     conn.set_session(autocommit=True)
     cur = conn.cursor()
     
     # create sparkify database with UTF8 encoding
-    cur.execute("DROP DATABASE IF EXISTS sparkifydb")
-    cur.execute("CREATE DATABASE sparkifydb WITH ENCODING 'utf8' TEMPLATE template0")
+    cur.execute(database_drop.format(dbname))
+    cur.execute(database_create.format(dbname, template))
 
     # close connection to default database
     conn.close()
     
     # connect to sparkify database
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+    conn = connect(dbname)
     cur = conn.cursor()
     
     return cur, conn
@@ -36,15 +55,175 @@ def drop_tables(cur, conn):
         conn.commit()
 
 
-def create_tables(cur, conn):
+def table_queries(partitioned=False, bulk=False, encoded=False):
+    """
+    Returns the queries of the `create_table_queries` list, adapted to the options of 
+    create_tables. 
+    """
+    queries = []
+    for query in (create_table_queries_bulk if bulk else create_table_queries):
+        if partitioned and query == songplay_table_create:
+            query = songplay_table_create_partitioned
+        if encoded and query == songplay_table_create:
+            queries += [location_table_create, user_agent_table_create, songplay_encoded_table_create]
+            query = songplay_view_create
+        queries.append(query)
+    return queries
+
+
+def create_tables(cur, conn, partitioned=False, bulk=False, encoded=False):
     """
     Creates each table using the queries in `create_table_queries` list. 
+    With `partitioned`, songplays is created partitioned by month on start_time. 
+    With `bulk`, the tables are created unlogged and without most of their constraints 
+    (`create_table_queries_bulk`); `etl.py --bulk` adds them back after the load. 
+    With `encoded`, songplays is a view over songplays_encoded and the location and user agent 
+    dictionaries. 
+    """
+    for query in table_queries(partitioned, bulk, encoded):
+        cur.execute(query)
+        conn.commit()
+
+
+def create_indexes(cur, conn):
     """
-    for query in create_table_queries:
+    Creates the indexes supporting the song lookups using the queries in `create_index_queries` list, 
+    and the indexes approved with advisor.py. 
+    """
+    for query in create_index_queries + advised_index_queries():
         cur.execute(query)
         conn.commit()
 
 
+def schema_version(partitioned=False, bulk=False, encoded=False):
+    """
+    Returns a hash of every statement the schema is created with, which changes whenever 
+    sql_queries.py or the options change the schema. 
+    """
+    queries = table_queries(partitioned, bulk, encoded) + ([] if bulk else create_index_queries + advised_index_queries())
+    return hashlib.sha256('\n'.join(queries).encode()).hexdigest()[:16]
+
+
+def record_schema_version(cur, conn, version):
+    """
+    Stores the schema version in the database. 
+    """
+    cur.execute(schema_version_table_create)
+    cur.execute(schema_version_insert, (version,))
+    conn.commit()
+
+
+def database_version(cur, dbname):
+    """
+    Returns the schema version recorded in database `dbname`, or None if the database does not 
+    exist or has none. `cur` is a cursor on another database of the server. 
+    """
+    cur.execute(database_exists, (dbname,))
+    if not cur.fetchone():
+        return None
+    conn = connect(dbname)
+    try:
+        db_cur = conn.cursor()
+        db_cur.execute(schema_version_check)
+        if not db_cur.fetchone()[0]:
+            return None
+        db_cur.execute(schema_version_select)
+        row = db_cur.fetchone()
+        return row[0] if row else None
+    finally:
+        conn.close()
+
+
+def build_database(dbname='sparkifydb', partitioned=False, bulk=False, encoded=False):
+    """
+    Creates database `dbname` from scratch with all its tables and indexes, and records its 
+    schema version. 
+    """
+    cur, conn = create_database(dbname)
+    
+    drop_tables(cur, conn)
+    create_tables(cur, conn, partitioned=partitioned, bulk=bulk, encoded=encoded)
+    if not bulk:
+        create_indexes(cur, conn)
+    record_schema_version(cur, conn, schema_version(partitioned, bulk, encoded))
+
+    conn.close()
+
+
+def truncate_tables(cur, conn):
+    """
+    Empties every table but schema_version with one TRUNCATE, restarting the sequences of the 
+    dictionary tables. 
+    
+    Returns the tables emptied. 
+    """
+    cur.execute(reset_tables_select)
+    tables = [row[0] for row in cur.fetchall()]
+    cur.execute(reset_truncate.format(', '.join(tables)))
+    conn.commit()
+    return tables
+
+
+def reset_database(partitioned=False, bulk=False, encoded=False):
+    """
+    Empties sparkifydb as fast as its current state allows: 
+    
+    - if its recorded schema version is the one of the options, its tables are truncated, 
+      without dropping the database or disconnecting anybody 
+    - otherwise it is dropped and cloned from TEMPLATE_DATABASE, which is built first if it 
+      does not exist or is of another schema version 
+    
+    The bulk schema is always cloned, since etl.py --bulk turns the tables into regular ones. 
+    """
+    version = schema_version(partitioned, bulk, encoded)
+    start = time.perf_counter()
+    
+    conn = connect('studentdb')
+    conn.set_session(autocommit=True)
+    cur = conn.cursor()
+    current = database_version(cur, 'sparkifydb') == version and not bulk
+    template_current = database_version(cur, TEMPLATE_DATABASE) == version
+    conn.close()
+    
+    if current:
+        conn = connect('sparkifydb')
+        tables = truncate_tables(conn.cursor(), conn)
+        conn.close()
+        print('{} tables truncated in {:.2f}s'.format(len(tables), time.perf_counter() - start))
+        return
+    
+    if not template_current:
+        build_database(TEMPLATE_DATABASE, partitioned=partitioned, bulk=bulk, encoded=encoded)
+        print('{} built with schema version {}'.format(TEMPLATE_DATABASE, version))
+    cur, conn = create_database(template=TEMPLATE_DATABASE)
+    conn.close()
+    print('sparkifydb cloned from {} in {:.2f}s'.format(TEMPLATE_DATABASE, time.perf_counter() - start))
+
+
+def parse_args():
+    """
+    Reads the command line options. 
+    """
+    parser = argparse.ArgumentParser(description='Creates the sparkifydb database and its tables.')
+    parser.add_argument('--partitioned', action='store_true',
+                        help='partition songplays by month on start_time')
+    parser.add_argument('--bulk', action='store_true',
+                        help='create unlogged tables without primary keys, NOT NULL constraints and indexes for '
+                             'a fast initial load with etl.py --bulk')
+    parser.add_argument('--encoded', action='store_true',
+                        help='store the songplays locations and user agents in dictionary tables, with a '
+                             'songplays view showing the original columns')
+    parser.add_argument('--reset', action='store_true',
+                        help='truncate the tables if sparkifydb already has the schema of these options, and '
+                             'clone it from {} otherwise, instead of recreating it'.format(TEMPLATE_DATABASE))
+    args = parser.parse_args()
+    if args.bulk and args.partitioned:
+        parser.error('--bulk cannot be combined with --partitioned')
+    if args.encoded and (args.bulk or args.partitioned):
+        parser.error('--encoded cannot be combined with --bulk or --partitioned')
+    return args
+
+
 def main():
     """
     - Drops (if exists) and Creates the sparkify database. 
@@ -54,16 +233,19 @@ def main():
     
     - Drops all the tables.  
     
-    - Creates all tables needed. 
+    - Creates all tables needed, and the indexes supporting the song lookups. 
+    
+    - Records the schema version. 
     
     - Finally, closes the connection. 
-    """
-    cur, conn = create_database()
     
-    drop_tables(cur, conn)
-    create_tables(cur, conn)
-
-    conn.close()
+    With --reset, the tables are emptied instead (see reset_database). 
+    """
+    args = parse_args()
+    if args.reset:
+        reset_database(partitioned=args.partitioned, bulk=args.bulk, encoded=args.encoded)
+    else:
+        build_database(partitioned=args.partitioned, bulk=args.bulk, encoded=args.encoded)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,104 @@
+from sql_queries import songplay_encoded_check, dictionary_tables, dictionary_select, dictionary_insert, \
+                        dictionary_select_values, songplay_table_insert, songplay_encoded_insert, songplay_table_sizes
+
+# value -> id of every dictionary table, loaded on first use and extended as new values arrive
+dictionary_ids = {table: {} for table in dictionary_tables}
+
+# whether songplays is dictionary-encoded, looked up on first use
+is_encoded = None
+
+# whether dictionary_ids holds the dictionary tables of the current transaction
+dictionaries_loaded = False
+
+# position of the dictionary-encoded values in a songplays row
+encoded_columns = {'locations': 7, 'user_agents': 8}
+
+
+def encoded(cur):
+    """
+    Returns whether songplays was created dictionary-encoded (`create_tables.py --encoded`),
+    loading the dictionaries the first time it is.
+    """
+    global is_encoded
+    if is_encoded is None:
+        cur.execute(songplay_encoded_check)
+        is_encoded = cur.fetchone()[0]
+    if is_encoded and not dictionaries_loaded:
+        load_dictionaries(cur)
+    return is_encoded
+
+
+def load_dictionaries(cur):
+    """
+    Loads the value -> id mapping of every dictionary table.
+    """
+    global dictionaries_loaded
+    for table, (id_column, value_column) in dictionary_tables.items():
+        cur.execute(dictionary_select.format(id_column, value_column, table))
+        dictionary_ids[table] = dict(cur.fetchall())
+    dictionaries_loaded = True
+
+
+def forget():
+    """
+    Empties the dictionary caches, since the ids of values added in a transaction that is
+    rolled back no longer exist. They are loaded again on next use.
+    """
+    global dictionaries_loaded
+    for ids in dictionary_ids.values():
+        ids.clear()
+    dictionaries_loaded = False
+
+
+def encode_values(cur, table, values):
+    """
+    Returns the ids of `values` in dictionary `table`, adding the values it does not have yet.
+    Other workers may add the same values at the same time, so the ids are read back from the
+    table rather than taken from the insert.
+    """
+    ids = dictionary_ids[table]
+    missing = sorted({value for value in values if value not in ids})
+    if missing:
+        id_column, value_column = dictionary_tables[table]
+        cur.execute(dictionary_insert.format(id_column, value_column, table), (missing,))
+        cur.execute(dictionary_select_values.format(id_column, value_column, table), (missing,))
+        ids.update(cur.fetchall())
+    return [ids[value] for value in values]
+
+
+def encode_songplay_rows(cur, rows):
+    """
+    Replaces the location and user agent of songplays rows by their dictionary ids, in the
+    column order of `songplay_encoded_columns`.
+    """
+    rows = [list(row) for row in rows]
+    for table, position in encoded_columns.items():
+        for row, value_id in zip(rows, encode_values(cur, table, [row[position] for row in rows])):
+            row[position] = value_id
+    return [tuple(row) for row in rows]
+
+
+def encode_songplay_row(cur, row):
+    """
+    Single-row version of encode_songplay_rows.
+    """
+    return encode_songplay_rows(cur, [row])[0]
+
+
+def songplay_insert(cur):
+    """
+    Returns the single-row songplays insert for the schema in use.
+    """
+    return songplay_encoded_insert if encoded(cur) else songplay_table_insert
+
+
+def report_sizes(cur):
+    """
+    Prints and returns the size on disk of the songplays table, or of the encoded fact table
+    and its dictionaries.
+    """
+    cur.execute(songplay_table_sizes)
+    sizes = dict(cur.fetchall())
+    for table, size in sorted(sizes.items()):
+        print('{:<18} {:>10.1f} kB'.format(table, size / 1024))
+    return sizes
@@ -1,103 +1,1299 @@
 import os
+import io
 import glob
+import itertools
+import time
+import argparse
+import queue
+import functools
+import threading
+import multiprocessing
 import psycopg2
+import psycopg2.extras
 import pandas as pd
 from sql_queries import *
+import readers
+import partitions
+import encoding
+import metrics
+import rollups
+from song_index import SongIndex, song_match_key
+from manifest import create_manifest_table, pending_files, record_file
+from transactions import CommitPolicy
+from bulk_load import finish_bulk_load
+from prepared import PreparingConnection
+from loaders import LOADERS, LOADER_CHOICE_FILE, get_loaders
 
+SPARKIFY_DSN = "host=127.0.0.1 dbname=sparkifydb user=student password=student"
 
-def process_song_file(cur, filepath):
+# a chunk of process_log_file_chunked is held as raw lines and as a frame, then as the filtered 
+# frame with its time, users and songplay rows: about four times what the lines and frame take 
+CHUNK_MEMORY_FACTOR = 4
+MIN_CHUNK_LINES = 1000
+
+
+def connect(dsn=SPARKIFY_DSN, prepared=False):
+    
+    """
+    Connects to sparkifydb. With `prepared`, the connection PREPAREs the hot-path statements of 
+    sql_queries.py once and runs them with EXECUTE (see prepared.py). 
+    
+    """
+    
+    return psycopg2.connect(dsn, connection_factory=PreparingConnection if prepared else None)
+
+
+def insert_row(cur, table, query, row):
+    
+    """
+    Runs the single-row insert `query` of `table`, timing it and counting the row, and whether 
+    its ON CONFLICT clause kicked in, in metrics. 
+    
+    Returns the rowcount of the insert, 0 when the ON CONFLICT clause skipped the row. 
+    
+    """
+    
+    with metrics.timed('insert', table):
+        cur.execute(query, row)
+    metrics.count_rows(table, 1, cur.rowcount)
+    return cur.rowcount
+
+
+def process_song_file(cur, filepath, song_index=None):
     
     """
     This function takes a file from the song_data directory and inserts specific information in both 
-    the songs and artists tables. 
+    the songs and artists tables. If a SongIndex is given, the song is added to it as well. 
+    
+    Returns the number of rows written. 
     
     """
     
     # open song file
-    df = pd.read_json(filepath, lines = True)
+    with metrics.timed('read'):
+        df = pd.read_json(filepath, lines = True)
+
+    with metrics.timed('transform'):
+        song_data =  list(df[['song_id','title', 'artist_id', 'year', 'duration']].values[0])
+        artist_data = list(df[['artist_id','artist_name', 'artist_location', 'artist_latitude', 'artist_longitude']].values[0])
+        song_data.append(song_match_key(song_data[1], artist_data[1]))
 
     # insert song record
-    song_data =  list(df[['song_id','title', 'artist_id', 'year', 'duration']].values[0])
-    cur.execute(song_table_insert, song_data)
+    insert_row(cur, 'songs', song_table_insert, song_data)
     
     # insert artist record
-    artist_data = list(df[['artist_id','artist_name', 'artist_location', 'artist_latitude', 'artist_longitude']].values[0])
-    cur.execute(artist_table_insert, artist_data)
+    insert_row(cur, 'artists', artist_table_insert, artist_data)
+    
+    # keep the in-memory song lookup in step with the tables
+    if song_index is not None:
+        song_index.add(song_data[0], song_data[5], song_data[4], song_data[2])
+    
+    return 2
 
 
-def process_log_file(cur, filepath):
+def process_song_file_stream(cur, filepath, song_index=None):
+    
+    """
+    Drop-in replacement for process_song_file that reads the file with readers.read_song_file 
+    instead of pandas. 
+    
+    Returns the number of rows written. 
     
     """
-    This function takes a file from the log_data directory and inserts specific information in both 
-    the time and users tables. 
+    
+    return write_song_rows(cur, metrics.timed_iter('read', readers.read_song_file(filepath)), song_index)
+
+
+def write_song_rows(cur, rows, song_index=None):
+    
+    """
+    Inserts the (song row, artist row) pairs produced by readers.read_song_file. 
+    
+    Returns the number of rows written. 
+    
+    """
+    
+    num_rows = 0
+    for song_data, artist_data in rows:
+        insert_row(cur, 'songs', song_table_insert, song_data)
+        insert_row(cur, 'artists', artist_table_insert, artist_data)
+        num_rows += 2
+        
+        if song_index is not None:
+            song_index.add(song_data[0], song_data[5], song_data[4], song_data[2])
+    
+    return num_rows
+
+
+def process_song_files(cur, filepaths, song_index=None):
+    
+    """
+    Batch counterpart of process_song_file. Reads a group of song files, keeps the first record of 
+    every song_id and artist_id, and writes the batch with one multi-row upsert per table. 
+    
+    Returns the number of rows written. 
+    
+    """
+    
+    rows = song_table_rows(filepaths)
+    songs = {song[0]: song for song in rows['songs']}
+    
+    for table, insert, insert_values, table_rows in (('songs', song_table_insert, song_table_insert_values, rows['songs']),
+                                                     ('artists', artist_table_insert, artist_table_insert_values, rows['artists'])):
+        with metrics.timed('insert', table):
+            if hasattr(cur, 'execute_batch'):
+                # prepared statements take one row per EXECUTE, sent together; the rowcount is the last one's
+                cur.execute_batch(insert, table_rows, page_size=max(len(table_rows), 1))
+                rowcount = None
+            else:
+                psycopg2.extras.execute_values(cur, insert_values, table_rows, page_size=max(len(table_rows), 1))
+                rowcount = cur.rowcount
+        metrics.count_rows(table, len(table_rows), rowcount)
+    
+    # keep the in-memory song lookup in step with the tables
+    if song_index is not None:
+        for song_id, title, artist_id, year, duration, match_key in songs.values():
+            song_index.add(song_id, match_key, duration, artist_id)
+    
+    return len(songs) + len(rows['artists'])
+
+
+def song_table_rows(filepaths):
+    
+    """
+    Reads a group of song files into the rows of every song table, keeping the first record of 
+    every song_id and artist_id. 
+    
+    Returns a dict of table name to rows. 
+    
+    """
+    
+    pairs = itertools.chain.from_iterable(metrics.timed_iter('read', readers.read_song_file(filepath))
+                                          for filepath in filepaths)
+    return group_song_rows(pairs)
+
+
+def group_song_rows(pairs):
+    
+    """
+    Groups the (song row, artist row) pairs of readers.song_rows into the rows of every song 
+    table, keeping the first record of every song_id and artist_id. 
+    
+    Returns a dict of table name to rows. 
+    
+    """
+    
+    songs = {}
+    artists = {}
+    for song, artist in pairs:
+        songs.setdefault(song[0], song)
+        artists.setdefault(artist[0], artist)
+    return {'songs': list(songs.values()), 'artists': list(artists.values())}
+
+
+def process_song_files_loaders(cur, filepaths, loaders, song_index=None):
+    
+    """
+    Counterpart of process_song_files that writes every table with the loader strategy given 
+    for it in `loaders` (see loaders.py). Takes a single file or a batch of files. 
+    
+    Returns the number of rows written. 
+    
+    """
+    
+    if isinstance(filepaths, str):
+        filepaths = [filepaths]
+    rows = song_table_rows(filepaths)
+    num_rows = 0
+    for table, table_rows in rows.items():
+        with metrics.timed('insert', table):
+            num_rows += loaders[table].load(cur, table, table_rows)
+    
+    if song_index is not None:
+        for song_id, title, artist_id, year, duration, match_key in rows['songs']:
+            song_index.add(song_id, match_key, duration, artist_id)
+    
+    return num_rows
+
+
+def get_time_df(df):
+    
+    """
+    This function takes the NextSong events of a log file (with `ts` already converted to datetime) 
+    and builds the rows of the time table in the column order of `time_table_columns`. 
+    
+    """
+    
+    t = df['ts']
+    time_data = (t, t.dt.hour, t.dt.day, t.dt.isocalendar().week.astype('int64'), t.dt.month, t.dt.year, t.dt.weekday)
+    column_labels = ('ts', 'hour', 'day', 'week', 'month', 'year', 'weekday')
+    return pd.DataFrame(dict(zip(column_labels, time_data)))
+
+
+def get_user_df(df):
+    
+    """
+    This function takes the NextSong events of a log file and returns the rows of the users table. 
+    
+    """
+    
+    return df[['userId', 'firstName', 'lastName', 'gender', 'level']]
+
+
+def collapse_user_df(df):
+    
+    """
+    This function keeps only the latest NextSong event of every user and returns its users row 
+    with `ts` as level_updated_at, in the column order of `user_latest_columns`. 
+    
+    """
+    
+    latest = df.sort_values('ts', kind='mergesort').drop_duplicates('userId', keep='last')
+    return get_user_df(latest).assign(level_updated_at = latest['ts'])
+
+
+def upsert_users(cur, user_rows):
+    
+    """
+    Writes the collapsed users rows with one multi-row upsert that never lets an older event 
+    overwrite the level of a newer one. The rows are upserted in user_id order, so that 
+    concurrent file transactions lock the users they share in the same order and cannot deadlock. 
+    
+    """
+    
+    if not user_rows:
+        return
+    user_rows = sorted(user_rows, key=lambda row: int(row[0]))
+    with metrics.timed('insert', 'users'):
+        if hasattr(cur, 'execute_batch'):
+            # prepared statements take one row per EXECUTE, sent together; the rowcount is the last one's
+            cur.execute_batch(user_table_upsert_latest_row, user_rows, page_size=len(user_rows))
+            rowcount = None
+        else:
+            psycopg2.extras.execute_values(cur, user_table_upsert_latest, user_rows, page_size=len(user_rows))
+            rowcount = cur.rowcount
+    metrics.count_rows('users', len(user_rows), rowcount)
+
+
+def read_log_file(filepath):
+    
+    """
+    This function opens a log file, keeps only the NextSong events, adds their songplay_id 
+    (readers.songplay_key) and converts the `ts` column to datetime. 
     
     """
     
     # open log file
     df = pd.read_json(filepath, lines = True) 
+    
+    return prepare_log_df(df)
+
 
+def prepare_log_df(df):
+    
+    """
+    Keeps the NextSong events of a frame of log records, adds their songplay_id and converts 
+    the `ts` column to datetime. 
+    
+    """
+    
     # filter by NextSong action
     df = df[df['page'] == 'NextSong' ]
 
+    # identify every songplay by its session, item in session, user and ts
+    df = df.assign(songplay_id = [readers.songplay_key(*key) for key in
+                                  zip(df['sessionId'], df['itemInSession'], df['userId'], df['ts'])])
+
     # convert timestamp column to datetime
-    t = pd.to_datetime(df['ts'], unit = 'ms')
     df['ts'] = pd.to_datetime(df['ts'], unit='ms')
     
-    # insert time data records
-    time_data = (t, t.dt.hour, t.dt.day, t.dt.week, t.dt.month, t.dt.year, t.dt.weekday)
-    column_labels = ('ts', 'hour', 'day', 'week', 'month', 'year', 'weekday')
-    time_df = pd.DataFrame(dict(zip(column_labels, time_data)))
+    return df
 
-    for i, row in time_df.iterrows():
-        cur.execute(time_table_insert, list(row))
 
-    # load user table
-    user_df = df[['userId', 'firstName', 'lastName', 'gender', 'level']]
+def process_log_file(cur, filepath, song_index=None, time_loaded=False):
+    
+    """
+    This function takes a file from the log_data directory and inserts specific information in both 
+    the time and users tables. 
+    
+    Songplays are resolved against a SongIndex when one is given, and with one `song_select` 
+    query per event otherwise. With `time_loaded`, the time table was already filled by 
+    load_time_dimension and is skipped. The songplays that were new are added to the rollup 
+    tables (rollups.py). 
+    
+    Returns the number of rows written. 
+    
+    """
+    
+    with metrics.timed('read'):
+        df = read_log_file(filepath)
+    
+    return write_log_df(cur, df, song_index, time_loaded)
+
+
+def write_log_df(cur, df, song_index=None, time_loaded=False):
+    
+    """
+    Inserts the time, user and songplay rows of a frame of NextSong events, as returned by 
+    read_log_file, see process_log_file. 
+    
+    Returns the number of rows written. 
+    
+    """
+    
+    with metrics.timed('transform'):
+        time_df = get_time_df(df) if not time_loaded else df.iloc[:0]
+        # load user table, one row per user with its latest level
+        user_df = collapse_user_df(df)
+        user_rows = [tuple(row) for row in user_df.itertuples(index=False)]
+    
+    # insert time data records
+    for i, row in time_df.iterrows():
+        insert_row(cur, 'time', time_table_insert, list(row))
 
     # insert user records
-    for i, row in user_df.iterrows():
-        cur.execute(user_table_insert, row)
+    upsert_users(cur, user_rows)
+
+    # resolve every songplay in memory at once
+    if song_index is not None:
+        with metrics.timed('lookup'):
+            song_ids, artist_ids = song_index.resolve(df)
+        metrics.count_lookups(song_ids)
+
+    # build the songplay records
+    songplays = []
+    for i, (index, row) in enumerate(df.iterrows()):
+        
+        # get songid and artistid from the song index or the song and artist tables
+        if song_index is not None:
+            songid, artistid = song_ids[i], artist_ids[i]
+        else:
+            with metrics.timed('lookup'):
+                cur.execute(song_select, (song_match_key(row.song, row.artist), row.length))
+                results = cur.fetchone()
+            
+            if results:
+                songid, artistid = results
+            else:
+                songid, artistid = None, None
+            metrics.count_lookups([songid])
+
+        songplays.append((row.songplay_id, row.ts, row.userId, row.level, songid, artistid, row.sessionId, row.location, row.userAgent))
+    
+    # with the dictionary-encoded schema, location and user agent become ids
+    songplay_insert = encoding.songplay_insert(cur)
+    if songplay_insert == songplay_encoded_insert:
+        with metrics.timed('transform'):
+            songplays = encoding.encode_songplay_rows(cur, songplays)
+    
+    # insert songplay records, and add the ones that were new to the rollups
+    partitions.ensure_songplay_partitions(cur, df['ts'])
+    inserted = [songplay_data for songplay_data in songplays
+                if insert_row(cur, 'songplays', songplay_insert, songplay_data) == 1]
+    rollups.add_songplays(cur, inserted)
+    
+    return len(time_df) + len(user_df) + len(df)
+
+
+def process_log_file_chunked(cur, filepath, song_index=None, time_loaded=False, chunk_lines=100000, max_rss=None):
+    
+    """
+    Memory-bounded counterpart of process_log_file for event files too large to load at once: 
+    the file is read `chunk_lines` lines at a time and every chunk goes through write_log_df, 
+    so only one chunk and its time, user and songplay rows are in memory. The users upsert 
+    never replaces a newer level with an older one, so a user spread over several chunks ends 
+    up with the same row. 
+    
+    With `max_rss` (bytes), the chunks are shrunk to what the ceiling leaves room for, going by 
+    the memory each line took so far, and the file fails with a MemoryError (which rolls it 
+    back) if the process goes above the ceiling anyway. 
+    
+    Returns the number of rows written. 
+    
+    """
+    
+    num_rows = 0
+    lines_read = 0
+    chunk_bytes = 0
+    baseline = metrics.current_rss()
+    with open(filepath) as f:
+        while True:
+            with metrics.timed('read'):
+                lines = list(itertools.islice(f, chunk_lines))
+                if not lines:
+                    break
+                chunk = pd.read_json(io.StringIO(''.join(lines)), lines = True)
+                lines_read += len(lines)
+                chunk_bytes += sum(len(line) for line in lines) + chunk.memory_usage(deep=True).sum()
+                del lines
+                df = prepare_log_df(chunk)
+                del chunk
+            
+            num_rows += write_log_df(cur, df, song_index, time_loaded)
+            del df
+            
+            if max_rss is not None and baseline is not None:
+                rss = metrics.current_rss()
+                if rss > max_rss:
+                    raise MemoryError('{} MB resident after {} lines, above the ceiling of {} MB'.format(
+                        rss // 2**20, lines_read, max_rss // 2**20))
+                chunk_lines = chunk_lines_within(max_rss - baseline, chunk_bytes / lines_read, chunk_lines)
+    
+    return num_rows
+
+
+def chunk_lines_within(budget, bytes_per_line, chunk_lines):
+    
+    """
+    Returns the number of lines, at most `chunk_lines` and at least MIN_CHUNK_LINES, whose 
+    chunk fits in `budget` bytes, counting CHUNK_MEMORY_FACTOR times the `bytes_per_line` the 
+    raw lines and their frame took. 
+    
+    """
+    
+    fitting = int(budget / (bytes_per_line * CHUNK_MEMORY_FACTOR)) if bytes_per_line else chunk_lines
+    return max(MIN_CHUNK_LINES, min(chunk_lines, fitting))
+
+
+def process_log_file_stream(cur, filepath, song_index=None, time_loaded=False):
+    
+    """
+    Drop-in replacement for process_log_file that streams the NextSong events with 
+    readers.read_log_file instead of loading the whole file into pandas. 
+    
+    Returns the number of rows written. 
+    
+    """
+    
+    return write_log_events(cur, metrics.timed_iter('read', readers.read_log_file(filepath)), song_index, time_loaded)
+
 
-    # insert songplay records
-    for index, row in df.iterrows():
+def process_log_files(cur, filepaths, song_index=None, time_loaded=False):
+    
+    """
+    Batch counterpart of process_log_file_stream: the events of a group of log files are written 
+    together, so each user gets a single upsert for the whole batch. 
+    
+    Returns the number of rows written. 
+    
+    """
+    
+    events = itertools.chain.from_iterable(metrics.timed_iter('read', readers.read_log_file(filepath))
+                                           for filepath in filepaths)
+    return write_log_events(cur, events, song_index, time_loaded)
+
+
+def write_log_events(cur, events, song_index=None, time_loaded=False):
+    
+    """
+    Inserts the time, user and songplay rows of the LogEvents produced by readers.read_log_file. 
+    The time rows are skipped with `time_loaded`. Users are collapsed to their latest event and 
+    upserted once each at the end, along with the rollups of the songplays that were new. 
+    
+    Returns the number of rows written. 
+    
+    """
+    
+    num_rows = 0
+    users = {}
+    inserted = []
+    songplay_insert = encoding.songplay_insert(cur)
+    for event in events:
+        if not time_loaded:
+            insert_row(cur, 'time', time_table_insert, readers.time_row(event.start_time))
+            num_rows += 1
+        
+        with metrics.timed('transform'):
+            latest = users.get(event.user_id)
+            if latest is None or latest[-1] <= event.start_time:
+                users[event.user_id] = readers.user_row(event) + (event.start_time,)
+        
+        # get songid and artistid from the song index or the song and artist tables
+        with metrics.timed('lookup'):
+            if song_index is not None:
+                songid, artistid = song_index.lookup(event.song, event.artist, event.length)
+            else:
+                cur.execute(song_select, (song_match_key(event.song, event.artist), event.length))
+                results = cur.fetchone()
+                songid, artistid = results if results else (None, None)
+        metrics.count_lookups([songid])
         
-        # get songid and artistid from song and artist tables
-        cur.execute(song_select, (row.song, row.artist, row.length))
-        results = cur.fetchone()
+        songplay_data = readers.songplay_row(event, songid, artistid)
+        if songplay_insert == songplay_encoded_insert:
+            songplay_data = encoding.encode_songplay_row(cur, songplay_data)
+        partitions.ensure_songplay_partitions(cur, (event.start_time,))
+        if insert_row(cur, 'songplays', songplay_insert, songplay_data) == 1:
+            inserted.append(songplay_data)
+        num_rows += 1
+    
+    upsert_users(cur, list(users.values()))
+    rollups.add_songplays(cur, inserted)
+    return num_rows + len(users)
+
+
+def log_table_rows(cur, filepaths, song_index=None, time_loaded=False):
+    
+    """
+    Reads a group of log files into the rows of every log table, see group_log_events. 
+    
+    Returns a dict of table name to rows. 
+    
+    """
+    
+    events = itertools.chain.from_iterable(metrics.timed_iter('read', readers.read_log_file(filepath))
+                                           for filepath in filepaths)
+    return group_log_events(cur, events, song_index, time_loaded)
+
+
+def group_log_events(cur, events, song_index=None, time_loaded=False):
+    
+    """
+    Groups LogEvents into the rows of every log table: the distinct time rows (none with 
+    `time_loaded`), the users collapsed to their latest event and the songplays resolved 
+    against the song index, or with `cur` against the song and artist tables without one. 
+    
+    Returns a dict of table name to rows. 
+    
+    """
+    
+    time_rows = {}
+    users = {}
+    songplays = []
+    for event in events:
+        with metrics.timed('transform'):
+            if not time_loaded:
+                time_rows.setdefault(event.start_time, readers.time_row(event.start_time))
+            
+            latest = users.get(event.user_id)
+            if latest is None or latest[-1] <= event.start_time:
+                users[event.user_id] = readers.user_row(event) + (event.start_time,)
         
-        if results:
-            songid, artistid = results
+        with metrics.timed('lookup'):
+            if song_index is not None:
+                songid, artistid = song_index.lookup(event.song, event.artist, event.length)
+            else:
+                cur.execute(song_select, (song_match_key(event.song, event.artist), event.length))
+                results = cur.fetchone()
+                songid, artistid = results if results else (None, None)
+        metrics.count_lookups([songid])
+        songplays.append(readers.songplay_row(event, songid, artistid))
+    
+    # users in user_id order, like upsert_users, for the loaders that write the rows as given
+    return {'time': list(time_rows.values()), 'users': [users[user_id] for user_id in sorted(users, key=int)],
+            'songplays': songplays}
+
+
+def process_log_files_loaders(cur, filepaths, loaders, song_index=None, time_loaded=False):
+    
+    """
+    Counterpart of process_log_files that writes every table with the loader strategy given 
+    for it in `loaders` (see loaders.py). Takes a single file or a batch of files. 
+    
+    Returns the number of rows written. 
+    
+    """
+    
+    if isinstance(filepaths, str):
+        filepaths = [filepaths]
+    rows = log_table_rows(cur, filepaths, song_index, time_loaded)
+    partitions.ensure_songplay_partitions(cur, [songplay[1] for songplay in rows['songplays']])
+    if encoding.encoded(cur):
+        rows['songplays_encoded'] = encoding.encode_songplay_rows(cur, rows.pop('songplays'))
+    num_rows = 0
+    inserted = []
+    for table, table_rows in rows.items():
+        with metrics.timed('insert', table):
+            if table in ('songplays', 'songplays_encoded') and rollups.enabled(cur):
+                # the rollups count the songplays the insert wrote, not the ones another worker did
+                inserted = loaders[table].load_returning(cur, table, table_rows, songplay_returning)
+                num_rows += len(table_rows)
+            else:
+                num_rows += loaders[table].load(cur, table, table_rows)
+    rollups.add_songplays(cur, inserted)
+    return num_rows
+
+
+def copy_df(cur, df, table, columns):
+    
+    """
+    This function streams a DataFrame into `table` with a single COPY ... FROM STDIN. 
+    The DataFrame columns must already be in the order given by `columns`. 
+    
+    """
+    
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    cur.copy_expert(copy_staging_from_stdin.format(table, ', '.join(columns)), buffer)
+
+
+def create_staging_tables(cur, conn):
+    
+    """
+    Creates the temporary staging tables used by process_log_file_copy on this connection. 
+    They are emptied on every commit, so they only ever hold the file being loaded. 
+    
+    """
+    
+    for query in create_staging_table_queries:
+        cur.execute(query)
+    conn.commit()
+
+
+def process_log_file_copy(cur, filepath, time_loaded=False):
+    
+    """
+    This function is the bulk counterpart of process_log_file. The time, users and songplay frames 
+    are streamed into the staging tables with COPY and moved into the star schema with one 
+    INSERT ... SELECT ... ON CONFLICT per table, so the songplay lookup becomes a single join. 
+    
+    create_staging_tables must have been called on the connection first. With `time_loaded`, the 
+    time table was already filled by load_time_dimension and is skipped. 
+    
+    Returns the number of rows written. 
+    
+    """
+    
+    with metrics.timed('read'):
+        df = read_log_file(filepath)
+    
+    with metrics.timed('transform'):
+        time_df = get_time_df(df) if not time_loaded else df.iloc[:0]
+        # one user record per user, with the ts of its latest level
+        user_df = collapse_user_df(df)
+        # the songplay events with the song lookup columns
+        event_df = df.assign(match_key=[song_match_key(song, artist) for song, artist in zip(df['song'], df['artist'])])
+        event_df = event_df[['songplay_id', 'ts', 'userId', 'level', 'match_key', 'length', 'sessionId', 'location',
+                             'userAgent']]
+    
+    # the staging tables still hold the previous files if the transaction spans several files
+    cur.execute(staging_truncate)
+    
+    # stage time records
+    if not time_loaded:
+        with metrics.timed('insert', 'time'):
+            copy_df(cur, time_df, 'time_staging', time_table_columns)
+            cur.execute(time_staging_insert)
+        metrics.count_rows('time', len(time_df), cur.rowcount)
+    
+    # move the staged rows into the star schema; the songplay lookup is part of the insert's join
+    partitions.ensure_songplay_partitions(cur, df['ts'])
+    with metrics.timed('insert', 'users'):
+        copy_df(cur, user_df, 'user_staging', user_staging_columns)
+        cur.execute(user_staging_insert)
+    metrics.count_rows('users', len(user_df), cur.rowcount)
+    with metrics.timed('insert', 'songplays'):
+        copy_df(cur, event_df, 'songplay_staging', songplay_staging_columns)
+        if encoding.encoded(cur):
+            for table, (id_column, value_column) in dictionary_tables.items():
+                cur.execute(dictionary_staging_insert.format(id_column, value_column, table))
+            songplay_insert = songplay_encoded_staging_insert
+        else:
+            songplay_insert = songplay_staging_insert
+        # read back the songplays that were inserted, for the rollups
+        if rollups.enabled(cur):
+            cur.execute(rollups.returning_songplays(songplay_insert))
+            inserted = cur.fetchall()
         else:
-            songid, artistid = None, None
+            cur.execute(songplay_insert)
+            inserted = []
+    metrics.count_rows('songplays', len(event_df), cur.rowcount)
+    rollups.add_songplays(cur, inserted)
+    
+    return len(time_df) + len(user_df) + len(event_df)
 
-        # insert songplay record
-        songplay_data = (index, row.ts, row.userId, row.level, songid, artistid, row.sessionId, row.location, row.userAgent)
-        cur.execute(songplay_table_insert, songplay_data)
 
+def load_time_dimension(cur, conn, filepath='data/log_data', manifest=False):
+    
+    """
+    Fills the time table for all the log files at once, instead of inserting every timestamp of 
+    every file. The distinct NextSong `ts` values of all the files are collected first, the time 
+    columns are derived for all of them in one vectorized pass, and only the timestamps that are 
+    not in the time table yet are loaded with COPY. 
+    
+    With `manifest`, only the new or modified log files are read. 
+    
+    Returns the number of rows written. 
+    
+    """
+    
+    with metrics.timed('discovery'):
+        all_files = get_files(filepath)
+        if manifest:
+            all_files = pending_files(cur, conn, all_files)
+    
+    start = time.perf_counter()
+    timestamps = set()
+    with metrics.timed('read'):
+        for datafile in all_files:
+            timestamps.update(record['ts'] for record in readers.iter_records(datafile) if record['page'] == 'NextSong')
+    
+    with metrics.timed('transform'):
+        df = pd.DataFrame({'ts': pd.to_datetime(sorted(timestamps), unit='ms')})
+        time_df = get_time_df(df)
+    
+    # skip the timestamps the time table already has
+    if len(time_df):
+        with metrics.timed('lookup'):
+            cur.execute(time_select_range, (time_df['ts'].iloc[0].to_pydatetime(), time_df['ts'].iloc[-1].to_pydatetime()))
+            existing = pd.to_datetime([row[0] for row in cur.fetchall()])
+            time_df = time_df[~time_df['ts'].isin(existing)]
+        with metrics.timed('insert', 'time'):
+            copy_df(cur, time_df, 'time', time_table_columns)
+        metrics.count_rows('time', len(time_df), len(time_df))
+    with metrics.timed('commit'):
+        conn.commit()
+    
+    print('{} distinct timestamps in {} files, {} new time rows loaded in {:.2f}s'.format(
+        len(timestamps), len(all_files), len(time_df), time.perf_counter() - start))
+    return len(time_df)
 
-def process_data(cur, conn, filepath, func):
+
+def get_files(filepath):
     
     """
-    This function takes files from specific directories and will in this case process (as func)
-    either process_song_file or process_log_file on each file in the directory. 
+    Returns the absolute paths of all the JSON files below `filepath`. 
     
     """
-    # get all files matching extension from directory
+    
     all_files = []
     for root, dirs, files in os.walk(filepath):
         files = glob.glob(os.path.join(root,'*.json'))
         for f in files :
             all_files.append(os.path.abspath(f))
+    return all_files
+
+
+def load_file(cur, conn, func, datafile, manifest=False, policy=None):
+    
+    """
+    Runs `func` on one file, or on a list of files for the batch functions, inside a savepoint. 
+    If it fails, only that file is rolled back and reported, and the load goes on. 
+    With `manifest`, the files are recorded as loaded (or failed) in the ingestion manifest within 
+    the same transaction. 
+    
+    The transaction is committed right away, or when `policy` (a CommitPolicy) says so. 
+    
+    Returns the number of rows written. 
+    
+    """
+    
+    datafiles = datafile if isinstance(datafile, list) else [datafile]
+    cur.execute(savepoint_create)
+    try:
+        num_rows = func(cur, datafile)
+        if manifest:
+            for f in datafiles:
+                record_file(cur, f, 'loaded')
+        cur.execute(savepoint_release)
+        metrics.count('files', 'loaded', len(datafiles))
+    except Exception as e:
+        cur.execute(savepoint_rollback)
+        # partitions and dictionary values created in the rolled back savepoint are gone again
+        partitions.created_months.clear()
+        encoding.forget()
+        print('{} rolled back: {}'.format(', '.join(datafiles), e))
+        if manifest:
+            for f in datafiles:
+                record_file(cur, f, 'failed')
+        metrics.count('files', 'failed', len(datafiles))
+        num_rows = 0
+    
+    if policy is None:
+        with metrics.timed('commit'):
+            conn.commit()
+    else:
+        policy.file_done(num_rows)
+    return num_rows
+
+
+def get_batches(all_files, batch_size):
+    
+    """
+    Splits the file list into lists of `batch_size` files for the batch functions. 
+    
+    """
+    
+    return [all_files[i:i + batch_size] for i in range(0, len(all_files), batch_size)]
+
+
+def process_data(cur, conn, filepath, func, manifest=False, batch_size=None, policy=None):
+    
+    """
+    This function takes files from specific directories and will in this case process (as func)
+    either process_song_file or process_log_file on each file in the directory. 
+    
+    With `batch_size`, `func` is a batch function such as process_song_files and is called (and 
+    committed) once per list of `batch_size` files. 
+    
+    `policy` is the CommitPolicy that decides how many files go into one transaction; by default 
+    every file is committed on its own. 
+    
+    With `manifest`, files already loaded and unchanged according to the ingestion manifest are 
+    skipped, so a run only loads new or modified files and resumes after the last committed one. 
+    
+    Returns the number of rows written and the elapsed time in seconds. 
+    
+    """
+    # get all files matching extension from directory
+    with metrics.timed('discovery'):
+        all_files = get_files(filepath)
 
     # get total number of files found
     num_files = len(all_files)
     print('{} files found in {}'.format(num_files, filepath))
 
-    # iterate over files and process
-    for i, datafile in enumerate(all_files, 1):
-        func(cur, datafile)
+    # skip the files that are already loaded
+    if manifest:
+        with metrics.timed('discovery'):
+            all_files = pending_files(cur, conn, all_files)
+        print('{} files are new or modified'.format(len(all_files)))
+        num_files = len(all_files)
+
+    # iterate over files (or batches of files) and process
+    if policy is None:
+        policy = CommitPolicy(conn)
+    num_rows = 0
+    num_done = 0
+    start = time.perf_counter()
+    for datafile in (get_batches(all_files, batch_size) if batch_size else all_files):
+        num_rows += load_file(cur, conn, func, datafile, manifest, policy)
+        num_done += len(datafile) if batch_size else 1
+        print('{}/{} files processed.'.format(num_done, num_files))
+    policy.commit()
+    elapsed = time.perf_counter() - start
+
+    policy.report()
+    print('{} rows loaded in {:.2f}s ({:.0f} rows/sec)'.format(num_rows, elapsed, num_rows / max(elapsed, 1e-9)))
+    return num_rows, elapsed
+
+
+def changed_files(filepath, seen, settle_seconds):
+    
+    """
+    Returns the files below `filepath` whose (size, mtime) is not the one recorded in `seen`, 
+    leaving out the files modified in the last `settle_seconds`, which may still be being 
+    written. 
+    
+    """
+    
+    now = time.time()
+    changed = []
+    for f in get_files(filepath):
+        try:
+            stat = os.stat(f)
+        except FileNotFoundError:
+            continue
+        if seen.get(f) != (stat.st_size, stat.st_mtime) and now - stat.st_mtime >= settle_seconds:
+            changed.append(f)
+    return changed
+
+
+def watch_data(cur, conn, filepath, func, batch=False, interval=5.0, batch_files=50, batch_seconds=60.0,
+               settle_seconds=2.0, metrics_prefix=None, max_polls=None):
+    
+    """
+    Long-running counterpart of process_data. Polls `filepath` every `interval` seconds for 
+    new or modified files (checked against the ingestion manifest) and loads them with `func` 
+    in micro-batches: as soon as `batch_files` files are waiting, or the oldest waiting file 
+    was found `batch_seconds` ago. Every micro-batch is one transaction; with `batch`, `func` 
+    is a batch function and is called once with all the files of the micro-batch. 
+    
+    After each commit the freshness latency, from a file landing (its mtime) to its rows being 
+    visible, is printed and recorded in metrics, and with `metrics_prefix` the metrics files 
+    are rewritten so that dashboards can follow it. Runs until interrupted, or for 
+    `max_polls` polls. 
+    
+    """
+    
+    seen = {}
+    waiting = []
+    first_waiting = None
+    polls = 0
+    print('watching {} every {:g}s'.format(filepath, interval))
+    try:
+        while max_polls is None or polls < max_polls:
+            polls += 1
+            with metrics.timed('discovery'):
+                candidates = [f for f in changed_files(filepath, seen, settle_seconds) if f not in waiting]
+                if candidates:
+                    new_files = pending_files(cur, conn, candidates)
+                    # files the manifest shows as loaded are not looked at again
+                    for f in set(candidates) - set(new_files):
+                        stat = os.stat(f)
+                        seen[f] = (stat.st_size, stat.st_mtime)
+                    if new_files and not waiting:
+                        first_waiting = time.time()
+                    waiting += new_files
+            
+            if waiting and (len(waiting) >= batch_files or time.time() - first_waiting >= batch_seconds):
+                load_micro_batch(cur, conn, func, waiting, batch, seen)
+                if metrics_prefix:
+                    metrics.write_json(metrics_prefix + '.json', {'watching': filepath})
+                    metrics.write_prometheus(metrics_prefix + '.prom')
+                waiting = []
+            elif max_polls is None or polls < max_polls:
+                time.sleep(interval)
+    except KeyboardInterrupt:
+        print('stopping, {} waiting files left for the next run'.format(len(waiting)))
+
+
+def load_micro_batch(cur, conn, func, files, batch, seen):
+    
+    """
+    Loads a micro-batch of files in one transaction for watch_data, records them in `seen` and 
+    reports the freshness latency of the batch. 
+    
+    """
+    
+    policy = CommitPolicy(conn, every_files=None)
+    stats = {f: os.stat(f) for f in files}
+    num_rows = 0
+    if batch:
+        num_rows += load_file(cur, conn, func, list(files), True, policy)
+    else:
+        for f in files:
+            num_rows += load_file(cur, conn, func, f, True, policy)
+    policy.commit()
+    committed = time.time()
+    
+    for f, stat in stats.items():
+        seen[f] = (stat.st_size, stat.st_mtime)
+    latencies = sorted(committed - stat.st_mtime for stat in stats.values())
+    metrics.set_gauge('freshness_seconds', latencies[-1])
+    metrics.set_gauge('last_batch_files', len(files))
+    metrics.set_gauge('last_batch_committed', committed)
+    print('{} files, {} rows loaded; freshness latency median {:.1f}s, max {:.1f}s'.format(
+        len(files), num_rows, latencies[len(latencies) // 2], latencies[-1]))
+
+
+# connection and file function of the current pool worker, set once by init_worker
+worker_conn = None
+worker_func = None
+worker_manifest = False
+
+
+def init_worker(dsn, func, manifest=False, prepared=False, phase='etl'):
+    
+    """
+    Pool initializer: every worker process opens its own connection to sparkifydb and receives 
+    the file function once, rather than with every file. 
+    
+    """
+    
+    global worker_conn, worker_func, worker_manifest
+    metrics.set_phase(phase)
+    worker_conn = connect(dsn, prepared)
+    worker_func = func
+    worker_manifest = manifest
+    create_staging_tables(worker_conn.cursor(), worker_conn)
+
+
+def process_file_in_worker(datafile):
+    
+    """
+    Runs the worker's file function on one file (or batch of files) with the worker's connection 
+    and commits it. Returns the number of files, the rows written, the seconds spent, the 
+    worker's pid and the metrics recorded for the file. 
+    
+    """
+    
+    metrics.reset()
+    cur = worker_conn.cursor()
+    start = time.perf_counter()
+    try:
+        num_rows = load_file(cur, worker_conn, worker_func, datafile, worker_manifest)
+    finally:
+        cur.close()
+    num_files = len(datafile) if isinstance(datafile, list) else 1
+    return num_files, num_rows, time.perf_counter() - start, os.getpid(), metrics.snapshot()
+
+
+def process_data_parallel(filepath, func, workers=4, dsn=SPARKIFY_DSN, manifest=False, cur=None, conn=None,
+                          batch_size=None, prepared=False):
+    
+    """
+    Parallel version of process_data. The files found in `filepath` are sharded across a pool of 
+    `workers` processes that each load them through their own connection, committing every file. 
+    Progress is printed in discovery order, whichever worker finishes first. 
+    
+    `func` must be picklable (a module level function or a functools.partial of one). 
+    With `manifest`, `cur` and `conn` are used to skip the files the manifest shows as loaded. 
+    With `batch_size`, the workers are handed batches of files for a batch function. 
+    With `prepared`, the workers' connections use prepared statements. 
+    
+    Returns a summary with the total rows, elapsed time and the files, rows, busy seconds and 
+    rows/sec of every worker. 
+    
+    """
+    
+    with metrics.timed('discovery'):
+        all_files = get_files(filepath)
+        if manifest:
+            print('{} files found in {}'.format(len(all_files), filepath))
+            all_files = pending_files(cur, conn, all_files)
+    num_files = len(all_files)
+    print('{} files to load from {} with {} workers'.format(num_files, filepath, workers))
+    
+    tasks = get_batches(all_files, batch_size) if batch_size else all_files
+    per_worker = {}
+    num_rows = 0
+    num_done = 0
+    start = time.perf_counter()
+    chunksize = max(1, len(tasks) // (workers * 4))
+    with multiprocessing.Pool(workers, initializer=init_worker,
+                              initargs=(dsn, func, manifest, prepared, metrics.phase)) as pool:
+        results = pool.imap(process_file_in_worker, tasks, chunksize)
+        for files, rows, seconds, pid, recorded in results:
+            metrics.merge(recorded)
+            stats = per_worker.setdefault(pid, {'files': 0, 'rows': 0, 'seconds': 0.0})
+            stats['files'] += files
+            stats['rows'] += rows
+            stats['seconds'] += seconds
+            num_rows += rows
+            num_done += files
+            print('{}/{} files processed.'.format(num_done, num_files))
+    elapsed = time.perf_counter() - start
+    
+    for pid, stats in sorted(per_worker.items()):
+        stats['rows_per_sec'] = stats['rows'] / max(stats['seconds'], 1e-9)
+        print('worker {}: {} files, {} rows in {:.2f}s ({:.0f} rows/sec)'.format(
+            pid, stats['files'], stats['rows'], stats['seconds'], stats['rows_per_sec']))
+    print('{} rows loaded in {:.2f}s ({:.0f} rows/sec)'.format(num_rows, elapsed, num_rows / max(elapsed, 1e-9)))
+    
+    return {'files': num_files, 'rows': num_rows, 'seconds': elapsed, 'workers': per_worker}
+
+
+def reader_thread(files, parsed, parse, stats, lock):
+    
+    """
+    Pipeline reader: takes files off the `files` queue, parses them with `parse` and puts 
+    (file, rows, error) on the bounded `parsed` queue. Time spent blocked on a full queue is 
+    added to stats['reader_stall'], since it means the writer is the bottleneck. 
+    
+    """
+    
+    while True:
+        datafile = files.get()
+        if datafile is None:
+            break
+        
+        start = time.perf_counter()
+        try:
+            item = (datafile, list(parse(datafile)), None)
+        except Exception as e:
+            item = (datafile, None, e)
+        parsed_at = time.perf_counter()
+        metrics.add_time('read', parsed_at - start)
+        
+        parsed.put(item)
+        with lock:
+            stats['read_seconds'] += parsed_at - start
+            stats['reader_stall'] += time.perf_counter() - parsed_at
+    
+    parsed.put(None)
+
+
+def raise_error(error):
+    
+    """
+    Returns a file function that raises the parse error of a reader, so that load_file rolls the 
+    file back and reports it like any other failing file. 
+    
+    """
+    
+    def func(cur, datafile):
+        raise error
+    return func
+
+
+def process_data_pipelined(cur, conn, filepath, parse, write, num_readers=2, queue_size=16,
+                           manifest=False, policy=None):
+    
+    """
+    Pipelined version of process_data. `num_readers` threads parse the files with `parse` 
+    (readers.read_song_file or readers.read_log_file) into a queue of at most `queue_size` files, 
+    while this thread drains it and writes each file with `write` (write_song_rows or 
+    write_log_events) through load_file, so parsing and database latency overlap. 
+    
+    Prints and returns the queue depth and the stall time of both sides: readers stalling on a 
+    full queue means the database is the bottleneck, the writer stalling on an empty queue means 
+    parsing is. 
+    
+    """
+    
+    with metrics.timed('discovery'):
+        all_files = get_files(filepath)
+        print('{} files found in {}'.format(len(all_files), filepath))
+        if manifest:
+            all_files = pending_files(cur, conn, all_files)
+            print('{} files are new or modified'.format(len(all_files)))
+    num_files = len(all_files)
+    
+    if policy is None:
+        policy = CommitPolicy(conn)
+    
+    files = queue.Queue()
+    for datafile in all_files:
+        files.put(datafile)
+    for i in range(num_readers):
+        files.put(None)
+    
+    parsed = queue.Queue(maxsize=queue_size)
+    lock = threading.Lock()
+    stats = {'read_seconds': 0.0, 'reader_stall': 0.0, 'write_seconds': 0.0, 'writer_stall': 0.0,
+             'queue_depth_sum': 0, 'queue_depth_max': 0}
+    threads = [threading.Thread(target=reader_thread, args=(files, parsed, parse, stats, lock), daemon=True)
+               for i in range(num_readers)]
+    for thread in threads:
+        thread.start()
+    
+    num_rows = 0
+    num_done = 0
+    running = num_readers
+    start = time.perf_counter()
+    while running:
+        depth = parsed.qsize()
+        wait_start = time.perf_counter()
+        item = parsed.get()
+        write_start = time.perf_counter()
+        stats['writer_stall'] += write_start - wait_start
+        
+        if item is None:
+            running -= 1
+            continue
+        
+        stats['queue_depth_sum'] += depth
+        stats['queue_depth_max'] = max(stats['queue_depth_max'], depth)
+        datafile, rows, error = item
+        if error is None:
+            func = lambda cur, datafile: write(cur, rows)
+        else:
+            func = raise_error(error)
+        num_rows += load_file(cur, conn, func, datafile, manifest, policy)
+        stats['write_seconds'] += time.perf_counter() - write_start
+        num_done += 1
+        print('{}/{} files processed.'.format(num_done, num_files))
+    policy.commit()
+    elapsed = time.perf_counter() - start
+    
+    for thread in threads:
+        thread.join()
+    
+    stats['queue_depth_mean'] = stats.pop('queue_depth_sum') / max(num_done, 1)
+    stats.update({'files': num_done, 'rows': num_rows, 'seconds': elapsed})
+    policy.report()
+    print('readers: {:.2f}s parsing, {:.2f}s stalled on a full queue'.format(stats['read_seconds'], stats['reader_stall']))
+    print('writer: {:.2f}s writing, {:.2f}s stalled on an empty queue'.format(stats['write_seconds'], stats['writer_stall']))
+    print('queue depth: mean {:.1f}, max {} of {}'.format(stats['queue_depth_mean'], stats['queue_depth_max'], queue_size))
+    print('{} rows loaded in {:.2f}s ({:.0f} rows/sec)'.format(num_rows, elapsed, num_rows / max(elapsed, 1e-9)))
+    return stats
+
+
+def compare_log_loaders(cur, conn, filepath='data/log_data', song_index=None):
+    
+    """
+    Loads the log files once with the row-by-row path and once with the COPY path, emptying the 
+    time, users and songplays tables before each run, and prints the rows/sec of both. 
+    If a SongIndex is given, the row-by-row path is also run with in-memory songplay resolution. 
+    The song data must already be loaded so that all paths resolve the same songplays. 
+    
+    """
+    
+    loaders = [('row-by-row', process_log_file), ('copy', process_log_file_copy)]
+    if song_index is not None:
+        loaders.insert(1, ('song-index', functools.partial(process_log_file, song_index=song_index)))
+    results = []
+    for name, func in loaders:
+        cur.execute(log_tables_truncate)
         conn.commit()
-        print('{}/{} files processed.'.format(i, num_files))
+        num_rows, elapsed = process_data(cur, conn, filepath=filepath, func=func)
+        results.append((name, num_rows, elapsed))
+    
+    print('{:<12} {:>10} {:>10} {:>12}'.format('loader', 'rows', 'seconds', 'rows/sec'))
+    for name, num_rows, elapsed in results:
+        print('{:<12} {:>10} {:>10.2f} {:>12.0f}'.format(name, num_rows, elapsed, num_rows / max(elapsed, 1e-9)))
+    
+    return results
+
+
+def parse_args():
+    
+    """
+    Reads the command line options of the ETL. 
+    
+    """
+    
+    parser = argparse.ArgumentParser(description='Loads the song and log data into sparkifydb.')
+    parser.add_argument('--copy', action='store_true',
+                        help='load the log files through COPY staging tables instead of row-by-row inserts')
+    parser.add_argument('--compare', action='store_true',
+                        help='load the log files with both the row-by-row and the COPY path and compare rows/sec')
+    parser.add_argument('--no-song-index', action='store_true',
+                        help='resolve songplays with one song_select query per event instead of the in-memory song index')
+    parser.add_argument('--song-index-file', metavar='PATH',
+                        help='load the song index from PATH if it exists and save it there after the run')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes, each with its own connection (default: 1, no pool)')
+    parser.add_argument('--reader', choices=['pandas', 'stream'], default='pandas',
+                        help='read the files with pandas or with the streaming JSON-lines reader (default: pandas)')
+    parser.add_argument('--pipeline', type=int, metavar='READERS',
+                        help='parse the files in READERS reader threads while the main thread writes them to the database')
+    parser.add_argument('--time-stage', action='store_true',
+                        help='load the time table once for all log files before the log phase, instead of per event')
+    parser.add_argument('--log-batch-size', type=int, metavar='N',
+                        help='write the log files in batches of N so that every user is upserted once per batch')
+    parser.add_argument('--song-batch-size', type=int, metavar='N',
+                        help='load the song files in batches of N with one multi-row upsert per table and batch')
+    parser.add_argument('--commit-every-files', type=int, default=1, metavar='N',
+                        help='commit after every N files (default: 1)')
+    parser.add_argument('--commit-every-rows', type=int, metavar='M',
+                        help='also commit as soon as M rows are pending')
+    parser.add_argument('--prepared', action='store_true',
+                        help='PREPARE the insert and lookup statements once per connection and run them with EXECUTE')
+    parser.add_argument('--full', action='store_true',
+                        help='load every file, ignoring which ones the ingestion manifest shows as already loaded')
+    parser.add_argument('--bulk', action='store_true',
+                        help='after loading into the tables of create_tables.py --bulk, add their constraints and '
+                             'indexes, switch them to logged and analyze them (implies --full)')
+    parser.add_argument('--loader', choices=['auto'] + sorted(LOADERS),
+                        help='write every table with this loader strategy, or with the fastest one calibrate.py '
+                             'recorded per table (auto, the default when {} exists and no other write path '
+                             'is chosen)'.format(LOADER_CHOICE_FILE))
+    parser.add_argument('--watch', action='store_true',
+                        help='after the song phase, keep watching data/log_data and load new log files in '
+                             'micro-batches instead of loading them once')
+    parser.add_argument('--watch-interval', type=float, default=5.0, metavar='SECONDS',
+                        help='how often --watch looks for new files (default: 5)')
+    parser.add_argument('--micro-batch-files', type=int, default=50, metavar='N',
+                        help='--watch loads the waiting files once N of them are waiting (default: 50)')
+    parser.add_argument('--micro-batch-seconds', type=float, default=60.0, metavar='SECONDS',
+                        help='or once the oldest of them has waited SECONDS (default: 60)')
+    parser.add_argument('--chunk-lines', type=int, metavar='N',
+                        help='read and load every log file N lines at a time, for event files too large for memory')
+    parser.add_argument('--max-rss', type=int, metavar='MB',
+                        help='with --chunk-lines, shrink the chunks to stay below MB megabytes resident, and fail '
+                             'a file that goes above it')
+    parser.add_argument('--metrics', default='etl_metrics', metavar='PREFIX',
+                        help='write the per-stage timings and counters of the run to PREFIX.json and, in the '
+                             'Prometheus text format, to PREFIX.prom (default: etl_metrics)')
+    args = parser.parse_args()
+    if args.loader and (args.copy or args.compare or args.pipeline):
+        parser.error('--loader cannot be combined with --copy, --compare or --pipeline')
+    # --time-stage only stages the files there at startup, the ones arriving while watching would get no time rows
+    if args.watch and (args.compare or args.workers > 1 or args.pipeline or args.full or args.bulk or args.time_stage):
+        parser.error('--watch cannot be combined with --compare, --workers, --pipeline, --full, --bulk or --time-stage')
+    if args.chunk_lines and (args.copy or args.compare or args.pipeline or args.loader or args.log_batch_size
+                             or args.reader == 'stream'):
+        parser.error('--chunk-lines cannot be combined with --copy, --compare, --pipeline, --loader, '
+                     '--log-batch-size or --reader stream')
+    if args.max_rss and not args.chunk_lines:
+        parser.error('--max-rss needs --chunk-lines')
+    if args.loader is None and os.path.exists(LOADER_CHOICE_FILE) and not (
+            args.copy or args.compare or args.pipeline or args.song_batch_size or args.log_batch_size
+            or args.reader == 'stream' or args.chunk_lines):
+        args.loader = 'auto'
+    return args
 
 
 def main():
@@ -108,13 +1304,145 @@ def main():
     
     """
     
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+    args = parse_args()
+    run_start = time.perf_counter()
+    phase_seconds = {}
+    
+    conn = connect(prepared=args.prepared)
     cur = conn.cursor()
+    
+    # only load new or modified files unless a full load is asked for
+    create_manifest_table(cur, conn)
+    # unlogged tables are emptied by a crash, so the manifest cannot vouch for them
+    manifest = not (args.full or args.bulk)
+
+    # build the song lookup once per run, it is kept up to date by process_song_file
+    song_index = None
+    if not args.no_song_index:
+        if args.song_index_file and os.path.exists(args.song_index_file):
+            try:
+                song_index = SongIndex.load(args.song_index_file)
+            except ValueError as e:
+                print('{}, rebuilding it'.format(e))
+        if song_index is None:
+            song_index = SongIndex.from_database(cur)
+        print('{} songs in the song index'.format(len(song_index)))
+
+    loaders = get_loaders(args.loader) if args.loader else None
+    if loaders:
+        print('loaders: ' + ', '.join('{} {}'.format(table, loader.name) for table, loader in loaders.items()))
+    
+    # the song phase has to be complete before the log phase resolves songplays against it
+    metrics.set_phase('songs')
+    phase_start = time.perf_counter()
+    if loaders:
+        song_func = functools.partial(process_song_files_loaders, loaders=loaders)
+    elif args.song_batch_size:
+        song_func = process_song_files
+    elif args.reader == 'stream':
+        song_func = process_song_file_stream
+    else:
+        song_func = process_song_file
+    if args.workers > 1:
+        process_data_parallel('data/song_data', song_func, workers=args.workers,
+                              manifest=manifest, cur=cur, conn=conn, batch_size=args.song_batch_size,
+                              prepared=args.prepared)
+        if song_index is not None:
+            # the workers filled their own copies of the index, so reload it from the database
+            song_index = SongIndex.from_database(cur)
+    elif args.pipeline:
+        process_data_pipelined(cur, conn, 'data/song_data', readers.read_song_file,
+                               functools.partial(write_song_rows, song_index=song_index),
+                               num_readers=args.pipeline, manifest=manifest,
+                               policy=CommitPolicy(conn, args.commit_every_files, args.commit_every_rows))
+    else:
+        process_data(cur, conn, filepath='data/song_data', func=functools.partial(song_func, song_index=song_index),
+                     manifest=manifest, batch_size=args.song_batch_size,
+                     policy=CommitPolicy(conn, args.commit_every_files, args.commit_every_rows))
+    
+    phase_seconds['songs'] = time.perf_counter() - phase_start
+    metrics.set_gauge('peak_rss_bytes', metrics.peak_rss())
+    
+    # the time table can be derived once for all the log files up front
+    time_loaded = args.time_stage and not args.compare
+    if time_loaded:
+        metrics.set_phase('time')
+        phase_start = time.perf_counter()
+        load_time_dimension(cur, conn, filepath='data/log_data', manifest=manifest)
+        phase_seconds['time'] = time.perf_counter() - phase_start
+        metrics.set_gauge('peak_rss_bytes', metrics.peak_rss())
+    
+    log_batch_size = None
+    if loaders:
+        log_func = functools.partial(process_log_files_loaders, loaders=loaders, song_index=song_index,
+                                     time_loaded=time_loaded)
+        log_batch_size = args.log_batch_size
+    elif args.copy:
+        log_func = functools.partial(process_log_file_copy, time_loaded=time_loaded)
+    elif args.log_batch_size:
+        log_func = functools.partial(process_log_files, song_index=song_index, time_loaded=time_loaded)
+        log_batch_size = args.log_batch_size
+    elif args.chunk_lines:
+        log_func = functools.partial(process_log_file_chunked, song_index=song_index, time_loaded=time_loaded,
+                                     chunk_lines=args.chunk_lines,
+                                     max_rss=args.max_rss * 2**20 if args.max_rss else None)
+    elif args.reader == 'stream':
+        log_func = functools.partial(process_log_file_stream, song_index=song_index, time_loaded=time_loaded)
+    else:
+        log_func = functools.partial(process_log_file, song_index=song_index, time_loaded=time_loaded)
+    
+    metrics.set_phase('logs')
+    phase_start = time.perf_counter()
+    if args.compare:
+        create_staging_tables(cur, conn)
+        compare_log_loaders(cur, conn, filepath='data/log_data', song_index=song_index)
+    elif args.watch:
+        if args.copy:
+            create_staging_tables(cur, conn)
+        watch_data(cur, conn, 'data/log_data', log_func, batch=bool(log_batch_size), interval=args.watch_interval,
+                   batch_files=args.micro_batch_files, batch_seconds=args.micro_batch_seconds,
+                   metrics_prefix=args.metrics)
+    elif args.workers > 1:
+        process_data_parallel('data/log_data', log_func, workers=args.workers,
+                              manifest=manifest, cur=cur, conn=conn, batch_size=log_batch_size,
+                              prepared=args.prepared)
+    elif args.pipeline:
+        process_data_pipelined(cur, conn, 'data/log_data', readers.read_log_file,
+                               functools.partial(write_log_events, song_index=song_index, time_loaded=time_loaded),
+                               num_readers=args.pipeline, manifest=manifest,
+                               policy=CommitPolicy(conn, args.commit_every_files, args.commit_every_rows))
+    else:
+        if args.copy:
+            create_staging_tables(cur, conn)
+        process_data(cur, conn, filepath='data/log_data', func=log_func, manifest=manifest, batch_size=log_batch_size,
+                     policy=CommitPolicy(conn, args.commit_every_files, args.commit_every_rows))
+    phase_seconds['logs'] = time.perf_counter() - phase_start
+    metrics.set_gauge('peak_rss_bytes', metrics.peak_rss())
+
+    if args.bulk:
+        metrics.set_phase('bulk')
+        phase_start = time.perf_counter()
+        finish_bulk_load(cur, conn)
+        phase_seconds['bulk'] = time.perf_counter() - phase_start
+        metrics.set_gauge('peak_rss_bytes', metrics.peak_rss())
 
-    process_data(cur, conn, filepath='data/song_data', func=process_song_file)
-    process_data(cur, conn, filepath='data/log_data', func=process_log_file)
+    if args.prepared:
+        conn.report()
+
+    if encoding.encoded(cur):
+        encoding.report_sizes(cur)
+
+    if song_index is not None and args.song_index_file:
+        song_index.save(args.song_index_file)
 
     conn.close()
+    print('peak RSS {:.0f} MB'.format(metrics.peak_rss() / 2**20))
+    
+    # where the run spent its time
+    run = {'seconds': time.perf_counter() - run_start, 'phase_seconds': phase_seconds, 'options': vars(args)}
+    metrics.write_json(args.metrics + '.json', run)
+    metrics.write_prometheus(args.metrics + '.prom', phase_seconds)
+    print('metrics written to {0}.json and {0}.prom'.format(args.metrics))
 
 
 if __name__ == "__main__":
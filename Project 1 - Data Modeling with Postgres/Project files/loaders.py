@@ -0,0 +1,194 @@
+import io
+import re
+import json
+import psycopg2.extras
+import metrics
+from sql_queries import loader_tables, loader_staging_create, loader_staging_truncate, loader_staging_insert, \
+                        copy_text_from_stdin
+
+# where calibrate.py records the fastest strategy of every table
+LOADER_CHOICE_FILE = 'loader_choice.json'
+
+
+def values_insert(insert):
+    """
+    Turns a single-row `VALUES (%s, ...)` insert into the `VALUES %s` form execute_values pages.
+    """
+    return re.sub(r'VALUES\s*\([^)]*\)', 'VALUES %s', insert, count=1)
+
+
+def conflict_clause(insert):
+    """
+    Returns the ON CONFLICT clause of an insert, so the COPY strategy resolves conflicts the
+    same way the row inserts do.
+    """
+    return insert[insert.index('ON CONFLICT'):] if 'ON CONFLICT' in insert else ';'
+
+
+def with_returning(insert, returning):
+    """
+    Appends a RETURNING clause to an insert.
+    """
+    return insert.rstrip().rstrip(';') + returning
+
+
+def copy_value(value):
+    """
+    Formats a value for COPY's text format.
+    """
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class ExecuteLoader:
+
+    """
+    One cur.execute per row, what the ETL always did.
+
+    """
+
+    name = 'execute'
+
+    def load(self, cur, table, rows):
+        columns, insert = loader_tables[table]
+        inserted = 0
+        for row in rows:
+            cur.execute(insert, row)
+            inserted += cur.rowcount
+        metrics.count_rows(table, len(rows), inserted)
+        return len(rows)
+
+    def load_returning(self, cur, table, rows, returning):
+        """
+        Loads `rows` like `load` and returns the `returning` columns of the rows that were
+        actually inserted, not those an ON CONFLICT clause skipped.
+        """
+        columns, insert = loader_tables[table]
+        insert = with_returning(insert, returning)
+        inserted = []
+        for row in rows:
+            cur.execute(insert, row)
+            inserted += cur.fetchall()
+        metrics.count_rows(table, len(rows), len(inserted))
+        return inserted
+
+
+class ExecuteManyLoader:
+
+    """
+    cur.executemany over the single-row insert.
+
+    """
+
+    name = 'executemany'
+
+    def load(self, cur, table, rows):
+        columns, insert = loader_tables[table]
+        cur.executemany(insert, rows)
+        # psycopg2 adds up the rowcount of every execution
+        metrics.count_rows(table, len(rows), cur.rowcount)
+        return len(rows)
+
+    def load_returning(self, cur, table, rows, returning):
+        """
+        executemany cannot fetch what its executions return, so the rows are inserted one
+        execute at a time, see ExecuteLoader.load_returning.
+        """
+        return ExecuteLoader().load_returning(cur, table, rows, returning)
+
+
+class ValuesLoader:
+
+    """
+    Multi-row `INSERT ... VALUES (...), (...)` statements of `page_size` rows.
+
+    """
+
+    name = 'values'
+
+    def __init__(self, page_size=1000):
+        self.page_size = page_size
+
+    def load(self, cur, table, rows):
+        columns, insert = loader_tables[table]
+        psycopg2.extras.execute_values(cur, values_insert(insert), rows, page_size=self.page_size)
+        # the rowcount is the last page's
+        metrics.count_rows(table, len(rows), cur.rowcount if len(rows) <= self.page_size else None)
+        return len(rows)
+
+    def load_returning(self, cur, table, rows, returning):
+        """
+        See ExecuteLoader.load_returning; execute_values fetches what every page returns.
+        """
+        columns, insert = loader_tables[table]
+        inserted = psycopg2.extras.execute_values(cur, with_returning(values_insert(insert), returning), rows,
+                                                  page_size=self.page_size, fetch=True)
+        metrics.count_rows(table, len(rows), len(inserted))
+        return inserted
+
+
+class CopyLoader:
+
+    """
+    COPY into a temporary staging table shaped like the target, then one INSERT ... SELECT
+    with the target insert's ON CONFLICT clause.
+
+    """
+
+    name = 'copy'
+
+    def load(self, cur, table, rows):
+        self.stage(cur, table, rows)
+        columns, insert = loader_tables[table]
+        cur.execute(loader_staging_insert.format(table, ', '.join(columns), '{}_loader_staging'.format(table)) + ' ' +
+                    conflict_clause(insert))
+        metrics.count_rows(table, len(rows), cur.rowcount)
+        return len(rows)
+
+    def load_returning(self, cur, table, rows, returning):
+        """
+        See ExecuteLoader.load_returning; the INSERT ... SELECT returns the rows it inserted.
+        """
+        self.stage(cur, table, rows)
+        columns, insert = loader_tables[table]
+        cur.execute(with_returning(loader_staging_insert.format(table, ', '.join(columns), '{}_loader_staging'.format(table)) +
+                                   ' ' + conflict_clause(insert), returning))
+        inserted = cur.fetchall()
+        metrics.count_rows(table, len(rows), len(inserted))
+        return inserted
+
+    def stage(self, cur, table, rows):
+        """
+        COPYs `rows` into the staging table of `table`, emptied first.
+        """
+        columns, insert = loader_tables[table]
+        staging = '{}_loader_staging'.format(table)
+        cur.execute(loader_staging_create.format(staging, table))
+        cur.execute(loader_staging_truncate.format(staging))
+
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write('\t'.join(copy_value(value) for value in row))
+            buffer.write('\n')
+        buffer.seek(0)
+        cur.copy_expert(copy_text_from_stdin.format(staging, ', '.join(columns)), buffer)
+
+
+LOADERS = {loader.name: loader for loader in (ExecuteLoader, ExecuteManyLoader, ValuesLoader, CopyLoader)}
+
+
+def get_loaders(strategy):
+    """
+    Returns the loader of every table for a strategy name, or for 'auto' the fastest loader
+    calibrate.py recorded for each table (execute where nothing was recorded).
+    """
+    if strategy != 'auto':
+        return {table: LOADERS[strategy]() for table in loader_tables}
+
+    try:
+        with open(LOADER_CHOICE_FILE) as f:
+            choice = json.load(f)['choice']
+    except (OSError, ValueError, KeyError):
+        choice = {}
+    return {table: LOADERS[choice.get(table, 'execute')]() for table in loader_tables}
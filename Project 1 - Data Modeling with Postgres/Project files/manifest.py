@@ -0,0 +1,80 @@
+import os
+import hashlib
+from sql_queries import manifest_table_create, manifest_select, manifest_upsert, manifest_touch, manifest_forget
+
+
+def file_hash(filepath):
+    """
+    Returns the sha1 of the content of a file.
+    """
+    sha1 = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def create_manifest_table(cur, conn):
+    """
+    Creates the ingestion manifest if it does not exist yet.
+    """
+    cur.execute(manifest_table_create)
+    conn.commit()
+
+
+def load_manifest(cur):
+    """
+    Returns the manifest as a dict of file path -> (size, mtime, content hash, status).
+    """
+    cur.execute(manifest_select)
+    return {path: (size, mtime, content_hash, status) for path, size, mtime, content_hash, status in cur.fetchall()}
+
+
+def pending_files(cur, conn, all_files):
+    """
+    Filters `all_files` down to the files that are not loaded yet or changed since they were loaded.
+
+    A file whose size and mtime match a loaded manifest entry is skipped without reading it.
+    If only the mtime moved but the content hash is the same, the new mtime is recorded and
+    the file is skipped as well.
+    """
+    manifest = load_manifest(cur)
+    pending = []
+    for filepath in all_files:
+        entry = manifest.get(filepath)
+        if entry is None or entry[3] != 'loaded':
+            pending.append(filepath)
+            continue
+
+        size, mtime, content_hash, status = entry
+        stat = os.stat(filepath)
+        if stat.st_size == size and stat.st_mtime == mtime:
+            continue
+        if stat.st_size == size and file_hash(filepath) == content_hash:
+            cur.execute(manifest_touch, (stat.st_mtime, filepath))
+            continue
+        pending.append(filepath)
+
+    conn.commit()
+    return pending
+
+
+def record_file(cur, filepath, status):
+    """
+    Records the size, mtime, content hash and load status of a file.
+
+    Called with status 'loaded' inside the transaction that loads the file, so the data and
+    its manifest entry are committed (or lost in a crash) together.
+    """
+    stat = os.stat(filepath)
+    cur.execute(manifest_upsert, (filepath, stat.st_size, stat.st_mtime, file_hash(filepath), status))
+
+
+def forget_files(cur, filepaths):
+    """
+    Removes the manifest entries of `filepaths`, so that the next run loads them again.
+
+    Returns the number of entries removed.
+    """
+    cur.execute(manifest_forget, (list(filepaths),))
+    return cur.rowcount
@@ -0,0 +1,265 @@
+import os
+import sys
+import json
+import time
+import resource
+import threading
+import contextlib
+import collections
+
+# the stages timed by the ETL: discovery, read, transform, lookup, insert, rollup and commit
+
+# counter name -> the label its values are split by
+COUNTER_LABELS = {'files': 'status',
+                  'rows_attempted': 'table',
+                  'rows_inserted': 'table',
+                  'row_conflicts': 'table',
+                  'songplay_lookups': 'result'}
+
+# phase the stages and counters are recorded under, set by the ETL ('songs', 'logs', ...)
+phase = 'etl'
+
+# (phase, stage) -> seconds and calls, (phase, table) -> seconds spent inserting into the table,
+# and (phase, counter, label) -> count, of this process
+stage_seconds = collections.defaultdict(float)
+stage_calls = collections.Counter()
+table_seconds = collections.defaultdict(float)
+counters = collections.Counter()
+
+# (phase, name) -> latest value, for what is a level rather than a total (watch mode freshness)
+gauges = {}
+
+# the pipeline reader threads record their stages concurrently with the writer
+lock = threading.Lock()
+
+
+def set_phase(name):
+    """
+    Records the stages and counters that follow under phase `name`.
+    """
+    global phase
+    phase = name
+
+
+def add_time(stage, seconds, calls=1, table=None):
+    """
+    Adds `seconds` spent in `stage` to the current phase, and to `table` if given.
+    """
+    with lock:
+        stage_seconds[phase, stage] += seconds
+        stage_calls[phase, stage] += calls
+        if table is not None:
+            table_seconds[phase, table] += seconds
+
+
+@contextlib.contextmanager
+def timed(stage, table=None):
+    """
+    Times the block it wraps as `stage` of the current phase, and as time spent on `table`
+    if given.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(stage, time.perf_counter() - start, table=table)
+
+
+def timed_iter(stage, iterable):
+    """
+    Yields the items of `iterable`, timing how long producing each one takes as `stage`, for
+    the streaming readers whose parsing is interleaved with the inserts.
+    """
+    iterator = iter(iterable)
+    seconds = 0.0
+    calls = 0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                seconds += time.perf_counter() - start
+                calls += 1
+            yield item
+    finally:
+        add_time(stage, seconds, calls)
+
+
+def count(name, label, n=1):
+    """
+    Adds `n` to counter `name` with label `label` in the current phase.
+    """
+    with lock:
+        counters[phase, name, label] += n
+
+
+def set_gauge(name, value):
+    """
+    Sets gauge `name` of the current phase to `value`.
+    """
+    with lock:
+        gauges[phase, name] = value
+
+
+def count_rows(table, attempted, rowcount=None):
+    """
+    Counts `attempted` rows written to `table`. With the `rowcount` of the statement, the rows
+    that were inserted and the ones an ON CONFLICT clause skipped or merged are counted as well.
+    """
+    count('rows_attempted', table, attempted)
+    if rowcount is not None and rowcount >= 0:
+        count('rows_inserted', table, rowcount)
+        count('row_conflicts', table, attempted - rowcount)
+
+
+def count_lookups(song_ids):
+    """
+    Counts the songplays that were matched to a song and the ones that were not.
+    """
+    hits = sum(song_id is not None for song_id in song_ids)
+    count('songplay_lookups', 'hit', hits)
+    count('songplay_lookups', 'miss', len(song_ids) - hits)
+
+
+def current_rss():
+    """
+    Returns the resident set size of this process in bytes, or None where /proc is missing.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def peak_rss():
+    """
+    Returns the largest resident set size this process reached, in bytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def snapshot():
+    """
+    Returns the stages and counters recorded so far, to send from a worker process.
+    """
+    with lock:
+        return dict(stage_seconds), dict(stage_calls), dict(table_seconds), dict(counters)
+
+
+def merge(recorded):
+    """
+    Adds a snapshot taken in a worker process to the stages and counters of this one.
+    """
+    seconds, calls, tables, counts = recorded
+    with lock:
+        for key, value in seconds.items():
+            stage_seconds[key] += value
+        for key, value in tables.items():
+            table_seconds[key] += value
+        stage_calls.update(calls)
+        counters.update(counts)
+
+
+def reset():
+    """
+    Forgets everything recorded so far.
+    """
+    with lock:
+        stage_seconds.clear()
+        stage_calls.clear()
+        table_seconds.clear()
+        counters.clear()
+        gauges.clear()
+
+
+def summary():
+    """
+    Returns the stages and counters of every phase as a JSON-serializable dict, with the row
+    and songplay lookup rates worked out.
+    """
+    phases = {}
+    for (name, stage), seconds in sorted(stage_seconds.items()):
+        stages = phases.setdefault(name, {}).setdefault('stages', {})
+        stages[stage] = {'calls': stage_calls[name, stage], 'seconds': seconds}
+    for (name, table), seconds in sorted(table_seconds.items()):
+        phases.setdefault(name, {}).setdefault('table_seconds', {})[table] = seconds
+    for (name, counter, label), value in sorted(counters.items()):
+        phases.setdefault(name, {}).setdefault(counter, {})[label] = value
+    for (name, gauge), value in sorted(gauges.items()):
+        phases.setdefault(name, {}).setdefault('gauges', {})[gauge] = value
+
+    for recorded in phases.values():
+        lookups = recorded.get('songplay_lookups')
+        if lookups:
+            total = lookups.get('hit', 0) + lookups.get('miss', 0)
+            lookups['hit_rate'] = lookups.get('hit', 0) / total if total else None
+        attempted, conflicts = recorded.get('rows_attempted', {}), recorded.get('row_conflicts', {})
+        if conflicts:
+            recorded['conflict_rate'] = {table: conflicts[table] / attempted[table] if attempted.get(table) else None
+                                         for table in conflicts}
+    return phases
+
+
+def write_atomically(path, text):
+    """
+    Writes `text` to `path` through a temporary file, so that readers (such as the node
+    exporter textfile collector) never see half a file.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def write_json(path, run=None):
+    """
+    Writes the summary of every phase, along with the `run` details (elapsed time, options,
+    ...), to `path` as JSON.
+    """
+    write_atomically(path, json.dumps({'run': run or {}, 'phases': summary()}, indent=2, default=str) + '\n')
+
+
+def write_prometheus(path, phase_seconds=None, prefix='sparkify_etl'):
+    """
+    Writes the stages and counters, and the wall-clock seconds of every phase if given, to
+    `path` in the Prometheus text exposition format.
+    """
+    lines = []
+    if phase_seconds:
+        lines += ['# HELP {}_phase_seconds Wall-clock seconds of each phase of the last run.'.format(prefix),
+                  '# TYPE {}_phase_seconds gauge'.format(prefix)]
+        for name, seconds in sorted(phase_seconds.items()):
+            lines.append('{}_phase_seconds{{phase="{}"}} {}'.format(prefix, name, seconds))
+    lines += ['# HELP {}_stage_seconds_total Seconds spent in each stage of the ETL.'.format(prefix),
+              '# TYPE {}_stage_seconds_total counter'.format(prefix)]
+    for (name, stage), seconds in sorted(stage_seconds.items()):
+        lines.append('{}_stage_seconds_total{{phase="{}",stage="{}"}} {}'.format(prefix, name, stage, seconds))
+    lines += ['# HELP {}_stage_calls_total Times each stage of the ETL ran.'.format(prefix),
+              '# TYPE {}_stage_calls_total counter'.format(prefix)]
+    for (name, stage), calls in sorted(stage_calls.items()):
+        lines.append('{}_stage_calls_total{{phase="{}",stage="{}"}} {}'.format(prefix, name, stage, calls))
+    lines += ['# HELP {}_table_seconds_total Seconds spent inserting into each table.'.format(prefix),
+              '# TYPE {}_table_seconds_total counter'.format(prefix)]
+    for (name, table), seconds in sorted(table_seconds.items()):
+        lines.append('{}_table_seconds_total{{phase="{}",table="{}"}} {}'.format(prefix, name, table, seconds))
+
+    for counter, label in COUNTER_LABELS.items():
+        values = sorted((key, value) for key, value in counters.items() if key[1] == counter)
+        if not values:
+            continue
+        lines += ['# TYPE {}_{}_total counter'.format(prefix, counter)]
+        for (name, _, label_value), value in values:
+            lines.append('{}_{}_total{{phase="{}",{}="{}"}} {}'.format(prefix, counter, name, label, label_value, value))
+
+    for gauge in sorted({gauge for name, gauge in gauges}):
+        lines += ['# TYPE {}_{} gauge'.format(prefix, gauge)]
+        for (name, _), value in sorted((key, value) for key, value in gauges.items() if key[1] == gauge):
+            lines.append('{}_{}{{phase="{}"}} {}'.format(prefix, gauge, name, value))
+
+    write_atomically(path, '\n'.join(lines) + '\n')
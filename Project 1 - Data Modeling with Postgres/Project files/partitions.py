@@ -0,0 +1,148 @@
+import argparse
+import datetime
+import readers
+import rollups
+from manifest import load_manifest, forget_files
+from sql_queries import songplay_partitioned_check, songplay_partition_lock, songplay_partition_create, \
+                        songplay_partition_truncate, songplay_partition_exists, rollup_tables, rollup_month_delete
+
+# months whose songplays partition this process already created (or found)
+created_months = set()
+
+# whether songplays is partitioned, looked up on first use
+is_partitioned = None
+
+
+def partition_name(month):
+    """
+    Returns the name of the songplays partition of the month starting at `month`.
+    """
+    return 'songplays_{:%Y_%m}'.format(month)
+
+
+def month_bounds(month):
+    """
+    Returns the first day of `month` and of the month after it.
+    """
+    start = datetime.date(month.year, month.month, 1)
+    end = datetime.date(start.year + start.month // 12, start.month % 12 + 1, 1)
+    return start, end
+
+
+def ensure_songplay_partitions(cur, start_times):
+    """
+    Creates the monthly songplays partitions needed for `start_times`, if songplays was
+    created partitioned. Does nothing for the plain songplays table.
+    """
+    global is_partitioned
+    if is_partitioned is None:
+        cur.execute(songplay_partitioned_check)
+        is_partitioned = cur.fetchone()[0]
+    if not is_partitioned:
+        return
+
+    months = {datetime.date(t.year, t.month, 1) for t in start_times} - created_months
+    if not months:
+        return
+
+    # several workers may see a new month at the same time
+    cur.execute(songplay_partition_lock)
+    for month in sorted(months):
+        start, end = month_bounds(month)
+        cur.execute(songplay_partition_create.format(partition_name(month)), (start, end))
+    created_months.update(months)
+
+
+def truncate_songplay_month(cur, month):
+    """
+    Empties the songplays of one month, touching only that month's partition.
+
+    Returns whether the month had a partition.
+    """
+    cur.execute(songplay_partition_exists, (partition_name(month),))
+    if not cur.fetchone()[0]:
+        return False
+    cur.execute(songplay_partition_truncate.format(partition_name(month)))
+    return True
+
+
+def month_log_files(filepaths, month):
+    """
+    Returns the log files among `filepaths` that hold a NextSong event of the month starting
+    at `month`.
+    """
+    return [filepath for filepath in filepaths
+            if any(datetime.date(event.start_time.year, event.start_time.month, 1) == month
+                   for event in readers.read_log_file(filepath))]
+
+
+def reload_songplay_month(cur, conn, month, filepaths):
+    """
+    Prepares the month starting at `month` to be loaded again by the next etl.py run, in one
+    transaction: its songplays partition is truncated, the rollup rows of its days and hours
+    are deleted, and the manifest entries of the log files among `filepaths` that hold its
+    events are removed. Those files are reloaded whole; their songplays of other months are
+    still there and skipped by the songplays insert, so they are not counted twice.
+
+    Returns the number of files to reload.
+    """
+    start, end = month_bounds(month)
+    truncated = truncate_songplay_month(cur, month)
+    if rollups.enabled(cur):
+        for table, (columns, aggregate) in rollup_tables.items():
+            cur.execute(rollup_month_delete.format(table, columns[1]), (start, end))
+    loaded = [filepath for filepath in load_manifest(cur) if filepath in filepaths]
+    num_files = forget_files(cur, month_log_files(loaded, month))
+    conn.commit()
+
+    print('{}: {}, {} log files to reload'.format(partition_name(month), 'truncated' if truncated else 'no partition',
+                                                  num_files))
+    return num_files
+
+
+def parse_month(value):
+    """
+    Parses a YYYY-MM month into the date of its first day.
+    """
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m').date()
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected a month as YYYY-MM, got {!r}'.format(value))
+
+
+def parse_args():
+    """
+    Reads the command line options.
+    """
+    parser = argparse.ArgumentParser(description='Prepares one month of songplays to be reloaded by the next etl.py '
+                                                 'run, on a database created with create_tables.py --partitioned.')
+    parser.add_argument('command', choices=('reload',),
+                        help='reload: truncate the month, delete its rollup rows and mark its log files to be loaded '
+                             'again')
+    parser.add_argument('month', type=parse_month, help='the month to reload, as YYYY-MM')
+    parser.add_argument('--log-data', default='data/log_data', metavar='PATH',
+                        help='the log files the month is looked up in (default: data/log_data)')
+    return parser.parse_args()
+
+
+def main():
+    """
+    Runs the reload command on sparkifydb.
+    """
+    # etl imports this module, so its functions are only looked up when run from the command line
+    from etl import connect, get_files
+
+    args = parse_args()
+    conn = connect()
+    cur = conn.cursor()
+
+    cur.execute(songplay_partitioned_check)
+    if not cur.fetchone()[0]:
+        raise SystemExit('songplays is not partitioned, run create_tables.py --partitioned first')
+    reload_songplay_month(cur, conn, args.month, set(get_files(args.log_data)))
+    conn.close()
+    print('run etl.py to load them again')
+
+
+if __name__ == "__main__":
+    main()
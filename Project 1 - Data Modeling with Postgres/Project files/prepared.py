@@ -0,0 +1,131 @@
+import re
+import json
+import time
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+from sql_queries import song_table_insert, artist_table_insert, user_table_insert, time_table_insert, \
+                        songplay_table_insert, song_select, user_table_upsert_latest_row, prepared_statement_stats, \
+                        prepared_statement_explain
+
+# the hot-path statements that are prepared, with their server-side names
+prepared_statements = {song_table_insert: 'song_insert',
+                       artist_table_insert: 'artist_insert',
+                       user_table_insert: 'user_insert',
+                       user_table_upsert_latest_row: 'user_upsert_latest',
+                       time_table_insert: 'time_insert',
+                       songplay_table_insert: 'songplay_insert',
+                       song_select: 'song_select'}
+
+
+def to_prepared(query):
+    """
+    Rewrites the %s placeholders of a query into the $1, $2, ... parameters PREPARE expects,
+    and returns the rewritten query with its number of parameters.
+    """
+    count = iter(range(1, query.count('%s') + 1))
+    return re.sub(r'%s', lambda match: '${}'.format(next(count)), query), query.count('%s')
+
+
+class PreparingCursor(psycopg2.extensions.cursor):
+
+    """
+    Cursor that runs the statements of `prepared_statements` as EXECUTE of a statement the
+    connection PREPAREd on first use, and every other statement as usual.
+
+    """
+
+    def execute(self, query, vars=None):
+        name = prepared_statements.get(query) if isinstance(query, str) else None
+        if name is None:
+            return super().execute(query, vars)
+        execute_query = self.connection.prepare(self, query, name)
+        self.connection.samples.setdefault(name, vars)
+        start = time.perf_counter()
+        result = super().execute(execute_query, vars)
+        self.connection.stats[name]['execute_seconds'] += time.perf_counter() - start
+        self.connection.stats[name]['executes'] += 1
+        return result
+
+    def execute_batch(self, query, rows, page_size=100):
+        """
+        Runs a prepared statement for every row, sending `page_size` EXECUTEs per round trip.
+        """
+        name = prepared_statements[query]
+        execute_query = self.connection.prepare(self, query, name)
+        if rows:
+            self.connection.samples.setdefault(name, rows[0])
+        start = time.perf_counter()
+        psycopg2.extras.execute_batch(self, execute_query, rows, page_size=page_size)
+        self.connection.stats[name]['execute_seconds'] += time.perf_counter() - start
+        self.connection.stats[name]['executes'] += len(rows)
+
+
+class PreparingConnection(psycopg2.extensions.connection):
+
+    """
+    Connection whose cursors are PreparingCursors. Keeps which statements it prepared, since
+    prepared statements live as long as the session, how long preparing and executing
+    them took, and the parameters of their first call.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = PreparingCursor
+        self.prepared = {}
+        self.stats = {}
+        self.samples = {}
+
+    def prepare(self, cur, query, name):
+        """
+        PREPAREs `query` as `name` unless it already is, and returns the EXECUTE statement to
+        call it with.
+        """
+        if name not in self.prepared:
+            prepared_query, num_params = to_prepared(query)
+            start = time.perf_counter()
+            psycopg2.extensions.cursor.execute(cur, 'PREPARE {} AS {}'.format(name, prepared_query))
+            self.stats[name] = {'prepare_seconds': time.perf_counter() - start, 'executes': 0, 'execute_seconds': 0.0}
+            self.prepared[name] = 'EXECUTE {} ({})'.format(name, ', '.join(['%s'] * num_params))
+        return self.prepared[name]
+
+    def report(self):
+        """
+        Prints and returns the time spent preparing (parse, analyze and rewrite) and executing
+        every prepared statement. PREPARE does not plan, so the planning and execution times of
+        one call are measured with an EXPLAIN ANALYZE of an EXECUTE with the parameters of the
+        first call, rolled back. If pg_stat_statements is installed with track_planning, the
+        server-side totals are printed as well.
+        """
+        for name, stats in sorted(self.stats.items()):
+            print('{:<20} prepared in {:8.2f}ms, {:>8} executes in {:8.2f}s'.format(
+                name, stats['prepare_seconds'] * 1000, stats['executes'], stats['execute_seconds']))
+
+        cur = psycopg2.extensions.cursor(self)
+        for name in sorted(self.samples):
+            try:
+                cur.execute(prepared_statement_explain.format(self.prepared[name]), self.samples[name])
+                plan = cur.fetchone()[0]
+                plan = (json.loads(plan) if isinstance(plan, str) else plan)[0]
+                self.stats[name].update(plan_ms=plan['Planning Time'], exec_ms=plan['Execution Time'])
+                # after five calls the server may switch to a cached generic plan, which is not planned again
+                print('{:<20} one EXECUTE: {:8.3f}ms planning, {:8.3f}ms executing'.format(
+                    name, plan['Planning Time'], plan['Execution Time']))
+            except psycopg2.Error as e:
+                print('{:<20} planning time not available: {}'.format(name, str(e).strip()))
+            finally:
+                # EXPLAIN ANALYZE runs the statement, its writes are undone
+                self.rollback()
+
+        try:
+            cur.execute(prepared_statement_stats)
+            for query, calls, plan_ms, exec_ms in cur.fetchall():
+                print('{:>8} calls, {:10.2f}ms planning, {:10.2f}ms executing: {}'.format(
+                    calls, plan_ms, exec_ms, ' '.join(query.split())[:60]))
+        except psycopg2.Error:
+            # pg_stat_statements is not available, keep the client-side times only
+            self.rollback()
+        finally:
+            cur.close()
+        return self.stats
@@ -0,0 +1,125 @@
+# Streaming readers for the Sparkify song and log files. They parse the JSON lines straight into
+# tuples in the column order of sql_queries.py, without building a DataFrame per file.
+import hashlib
+import datetime
+from collections import namedtuple
+from sql_queries import song_table_columns, artist_table_columns
+from song_index import song_match_key
+
+# orjson is used when it is installed
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    import json
+    loads = json.loads
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# a NextSong event, with its songplay_key
+LogEvent = namedtuple('LogEvent', ['songplay_id', 'start_time', 'user_id', 'first_name', 'last_name', 'gender', 'level',
+                                   'song', 'artist', 'length', 'session_id', 'location', 'user_agent'])
+
+
+def songplay_key(session_id, item_in_session, user_id, ts):
+    """
+    Returns the songplay_id of an event: a signed 64-bit hash of the session, item in session,
+    user and `ts` (in epoch milliseconds) that identify it. The same event gets the same id in
+    every file, run and worker, whereas its position in the file would restart in every file.
+    """
+    identity = '{}:{}:{}:{}'.format(int(session_id), int(item_in_session), int(user_id), int(ts)).encode()
+    return int.from_bytes(hashlib.blake2b(identity, digest_size=8).digest(), 'big', signed=True)
+
+
+def iter_records(filepath):
+    """
+    Yields the parsed JSON record of every non-empty line of a file.
+    """
+    with open(filepath, 'rb') as f:
+        yield from parse_records(f)
+
+
+def parse_records(lines):
+    """
+    Yields the parsed JSON record of every non-empty line of `lines`, such as an open file or
+    the content of a file split into lines.
+    """
+    for line in lines:
+        if line.strip():
+            yield loads(line)
+
+
+def read_song_file(filepath):
+    """
+    Yields a (song row, artist row) pair for every record of a song file, see song_rows.
+    """
+    return song_rows(iter_records(filepath))
+
+
+def song_rows(records):
+    """
+    Yields a (song row, artist row) pair for every song record, in the column order of the
+    songs and artists tables, the song ending with its match key. Missing artist coordinates
+    are NaN, as with pandas.
+    """
+    for record in records:
+        song = tuple(record[column] for column in song_table_columns[:-1]) + \
+               (song_match_key(record['title'], record['artist_name']),)
+        artist = tuple(float('nan') if record[column] is None and column in ('artist_latitude', 'artist_longitude')
+                       else record[column] for column in artist_table_columns)
+        yield song, artist
+
+
+def read_log_file(filepath):
+    """
+    Yields a LogEvent for every NextSong event of a log file, see log_events.
+    """
+    return log_events(iter_records(filepath))
+
+
+def log_events(records):
+    """
+    Yields a LogEvent for every NextSong event of the log records, with `ts` converted to a
+    datetime and the ids and length converted to numbers.
+    """
+    for record in records:
+        if record['page'] != 'NextSong':
+            continue
+        yield LogEvent(songplay_key(record['sessionId'], record['itemInSession'], record['userId'], record['ts']),
+                       EPOCH + datetime.timedelta(milliseconds=record['ts']),
+                       int(record['userId']),
+                       record['firstName'],
+                       record['lastName'],
+                       record['gender'],
+                       record['level'],
+                       record['song'],
+                       record['artist'],
+                       None if record['length'] is None else float(record['length']),
+                       int(record['sessionId']),
+                       record['location'],
+                       record['userAgent'])
+
+
+def time_row(start_time):
+    """
+    Returns the time table row of a timestamp, in the order of `time_table_columns`.
+    Week and weekday follow pandas: ISO week number and Monday = 0.
+    """
+    return (start_time, start_time.hour, start_time.day, start_time.isocalendar()[1],
+            start_time.month, start_time.year, start_time.weekday())
+
+
+def user_row(event):
+    """
+    Returns the users table row of an event, in the order of `user_table_columns`.
+    """
+    return (event.user_id, event.first_name, event.last_name, event.gender, event.level)
+
+
+def songplay_row(event, song_id, artist_id):
+    """
+    Returns the songplays table row of an event, in the order of `songplay_table_columns`.
+    """
+    return (event.songplay_id, event.start_time, event.user_id, event.level, song_id, artist_id,
+            event.session_id, event.location, event.user_agent)
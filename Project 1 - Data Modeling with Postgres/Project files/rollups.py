@@ -0,0 +1,140 @@
+import time
+import argparse
+import collections
+import datetime
+import psycopg2.extras
+import metrics
+from sql_queries import rollup_check, rollup_tables, rollup_upsert, rollup_truncate, rollup_rebuild, rollup_compare, \
+                        songplay_returning
+
+# whether the rollup tables exist, looked up on first use
+is_enabled = None
+
+
+def enabled(cur):
+    """
+    Returns whether the rollup tables exist; databases created before them are loaded without.
+    """
+    global is_enabled
+    if is_enabled is None:
+        cur.execute(rollup_check)
+        is_enabled = cur.fetchone()[0]
+    return is_enabled
+
+
+def songplay_deltas(songplays):
+    """
+    Returns the plays a list of songplays rows (or of rows starting with songplay_id,
+    start_time, user_id, level, song_id) add to every row of every rollup table. A songplay
+    listed twice is counted once, like its insert.
+    """
+    deltas = {table: collections.Counter() for table in rollup_tables}
+    seen = set()
+    for songplay in songplays:
+        songplay_id, start_time, user_id, song_id = songplay[0], songplay[1], songplay[2], songplay[4]
+        if songplay_id in seen:
+            continue
+        seen.add(songplay_id)
+        if user_id is not None:
+            deltas['user_daily_plays'][int(user_id), datetime.date(start_time.year, start_time.month, start_time.day)] += 1
+        if song_id is not None:
+            hour = datetime.datetime(start_time.year, start_time.month, start_time.day, start_time.hour)
+            deltas['song_hourly_plays'][song_id, hour] += 1
+    return deltas
+
+
+def add_songplays(cur, songplays):
+    """
+    Adds the songplays a file or batch inserted to the rollup tables, with one upsert per
+    table. The keys are sorted so that concurrent workers lock the rows they share in the
+    same order.
+
+    `songplays` must only hold the rows that were actually inserted, not the ones an
+    ON CONFLICT clause skipped, or a reloaded file would be counted twice.
+    """
+    if not songplays or not enabled(cur):
+        return
+    with metrics.timed('rollup'):
+        for table, counts in songplay_deltas(songplays).items():
+            if counts:
+                columns = rollup_tables[table][0]
+                psycopg2.extras.execute_values(cur, rollup_upsert.format(table, *columns),
+                                               sorted(key + (plays,) for key, plays in counts.items()))
+
+
+def returning_songplays(query):
+    """
+    Turns a songplays INSERT ... SELECT into one that returns the rows it inserted.
+    """
+    return query.rstrip().rstrip(';') + songplay_returning
+
+
+def rebuild(cur, conn):
+    """
+    Recomputes every rollup table from songplays, in one transaction.
+    """
+    for table, (columns, aggregate) in rollup_tables.items():
+        start = time.perf_counter()
+        cur.execute(rollup_truncate.format(table))
+        cur.execute(rollup_rebuild.format(table, columns[0], columns[1], aggregate))
+        print('{}: {} rows rebuilt in {:.2f}s'.format(table, cur.rowcount, time.perf_counter() - start))
+    conn.commit()
+
+
+def check(cur, limit=10):
+    """
+    Compares every rollup table with the aggregate of songplays it stands for, printing up to
+    `limit` differing rows of each.
+
+    Returns the number of differing rows per table.
+    """
+    differences = {}
+    for table, (columns, aggregate) in rollup_tables.items():
+        cur.execute(rollup_compare.format(table, columns[0], columns[1], aggregate))
+        rows = cur.fetchall()
+        differences[table] = len(rows)
+        print('{}: {}'.format(table, '{} rows differ'.format(len(rows)) if rows else 'consistent'))
+        for key1, key2, rollup_plays, songplays_plays in rows[:limit]:
+            print('  {} {}: {} in the rollup, {} in songplays'.format(key1, key2, rollup_plays, songplays_plays))
+    return differences
+
+
+def parse_args():
+    """
+    Reads the command line options.
+    """
+    parser = argparse.ArgumentParser(description='Rebuilds or checks the rollup tables the ETL maintains '
+                                                 'incrementally on top of songplays.')
+    parser.add_argument('command', choices=('rebuild', 'check'),
+                        help='rebuild: recompute the rollups from songplays; check: compare them with songplays '
+                             'and exit with status 1 if they differ')
+    parser.add_argument('--limit', type=int, default=10, metavar='N',
+                        help='differing rows printed per table by check (default: 10)')
+    return parser.parse_args()
+
+
+def main():
+    """
+    Runs the rebuild or check command on sparkifydb.
+    """
+    # etl imports this module, so connect is only looked up when run from the command line
+    from etl import connect
+
+    args = parse_args()
+    conn = connect()
+    cur = conn.cursor()
+
+    if not enabled(cur):
+        raise SystemExit('the rollup tables do not exist, run create_tables.py first')
+    if args.command == 'rebuild':
+        rebuild(cur, conn)
+        conn.close()
+    else:
+        differences = check(cur, limit=args.limit)
+        conn.close()
+        if any(differences.values()):
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import os
+import pickle
+import hashlib
+import functools
+from sql_queries import song_index_select
+
+# written along with the index by `save`, and bumped whenever the key changes
+INDEX_FORMAT = 4
+
+
+def normalize_match_text(value):
+    """
+    Turns every run of characters other than letters and decimal digits (Unicode categories L
+    and Nd, of any script) into one space, trims and lowercases. Superscripts, fractions,
+    roman numerals, combining marks and symbols are separators.
+    """
+    return ' '.join(''.join(c if c.isalpha() or c.isdecimal() else ' ' for c in value).split()).lower()
+
+
+@functools.lru_cache(maxsize=65536)
+def song_match_key(title, artist_name):
+    """
+    Returns the song-matching key of a title and an artist name: the md5 of both normalized
+    with normalize_match_text, or None when either is missing (None or NaN).
+
+    This is the only place the key is computed: songs.match_key is filled with it and
+    song_select and the COPY path's staged events are given it, since the character classes
+    of the database's regular expressions depend on its locale.
+    """
+    if not isinstance(title, str) or not isinstance(artist_name, str):
+        return None
+    return hashlib.md5('|'.join(normalize_match_text(value) for value in (title, artist_name)).encode()).hexdigest()
+
+
+class SongIndex:
+
+    """
+    In-memory replacement for `song_select`. Maps (match_key, duration) to the
+    (song_id, artist_id) pair of the songs table, so that songplays can be
+    resolved without a database round trip per event.
+
+    """
+
+    def __init__(self):
+        self._index = {}
+
+    def __len__(self):
+        return len(self._index)
+
+    @staticmethod
+    def make_key(match_key, duration):
+        """
+        Builds the lookup key the same way `song_select` compares its parameters.
+        """
+        return (match_key, None if duration is None else float(duration))
+
+    @classmethod
+    def from_database(cls, cur):
+        """
+        Builds the index from the songs rows currently in the database.
+        """
+        cur.execute(song_index_select)
+        return cls.from_rows(cur.fetchall())
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Builds the index from (song_id, match_key, duration, artist_id) rows, as returned by
+        `song_index_select`.
+        """
+        index = cls()
+        for song_id, match_key, duration, artist_id in rows:
+            index.add(song_id, match_key, duration, artist_id)
+        return index
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads an index previously written with `save`. Raises ValueError if it was written
+        with another key.
+        """
+        index = cls()
+        with open(path, 'rb') as f:
+            saved = pickle.load(f)
+        if not isinstance(saved, tuple) or saved[0] != INDEX_FORMAT:
+            raise ValueError('{} was written with another song index key'.format(path))
+        index._index = saved[1]
+        return index
+
+    def save(self, path):
+        """
+        Writes the index to `path`, replacing the previous file only once it is complete.
+        """
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((INDEX_FORMAT, self._index), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def add(self, song_id, match_key, duration, artist_id):
+        """
+        Adds a song to the index. The first song seen for a key is kept, like the
+        first row `song_select` would return.
+        """
+        self._index.setdefault(self.make_key(match_key, duration), (song_id, artist_id))
+
+    def lookup(self, title, artist_name, duration):
+        """
+        Returns the (song_id, artist_id) of a song, or (None, None) when it is unknown.
+        """
+        return self._index.get(self.make_key(song_match_key(title, artist_name), duration), (None, None))
+
+    def resolve(self, df):
+        """
+        Resolves every event of a log DataFrame in one pass and returns the song_id and
+        artist_id lists, aligned with the rows of `df`.
+        """
+        get, make_key = self._index.get, self.make_key
+        matches = [get(make_key(song_match_key(title, artist), length), (None, None))
+                   for title, artist, length in zip(df['song'], df['artist'], df['length'])]
+        song_ids = [song_id for song_id, artist_id in matches]
+        artist_ids = [artist_id for song_id, artist_id in matches]
+        return song_ids, artist_ids
@@ -5,10 +5,15 @@ user_table_drop = "DROP TABLE IF EXISTS users"
 song_table_drop = "DROP TABLE IF EXISTS songs"
 artist_table_drop = "DROP TABLE IF EXISTS artists"
 time_table_drop = "DROP TABLE IF EXISTS time"
+manifest_table_drop = "DROP TABLE IF EXISTS ingestion_manifest"
+user_daily_plays_table_drop = "DROP TABLE IF EXISTS user_daily_plays"
+song_hourly_plays_table_drop = "DROP TABLE IF EXISTS song_hourly_plays"
 
 # CREATE TABLES
 
-songplay_table_create = (""" CREATE TABLE IF NOT EXISTS songplays (songplay_id serial PRIMARY KEY, \
+# songplay_id is readers.songplay_key of the event, so reloading a file or loading files in
+# parallel never duplicates or drops a songplay
+songplay_table_create = (""" CREATE TABLE IF NOT EXISTS songplays (songplay_id bigint PRIMARY KEY, \
                                                                    start_time timestamp, \
                                                                    user_id int, \
                                                                    level varchar NOT NULL,\
@@ -18,18 +23,34 @@ songplay_table_create = (""" CREATE TABLE IF NOT EXISTS songplays (songplay_id s
                                                                    location varchar NOT NULL, \
                                                                    user_agent varchar NOT NULL)""")
 
+# songplays partitioned by month on start_time; the partitions are created by the ETL as
+# new months arrive (partitions.py). The partition key has to be part of the primary key.
+songplay_table_create_partitioned = ("""CREATE TABLE IF NOT EXISTS songplays (songplay_id bigint, \
+                                                                          start_time timestamp NOT NULL, \
+                                                                          user_id int, \
+                                                                          level varchar NOT NULL, \
+                                                                          song_id varchar, \
+                                                                          artist_id varchar, \
+                                                                          session_id int NOT NULL, \
+                                                                          location varchar NOT NULL, \
+                                                                          user_agent varchar NOT NULL, \
+                                                                          PRIMARY KEY (songplay_id, start_time)) \
+                                        PARTITION BY RANGE (start_time)""")
+
 user_table_create = ("""CREATE TABLE IF NOT EXISTS users (
                                                           user_id int PRIMARY KEY, \
                                                           first_name varchar, \
                                                           last_name varchar, \
                                                           gender varchar, \
-                                                          level varchar NOT NULL)""")
+                                                          level varchar NOT NULL, \
+                                                          level_updated_at timestamp)""")
 
 song_table_create = ("""CREATE TABLE IF NOT EXISTS songs (song_id varchar PRIMARY KEY, \
                                                           title varchar, \
                                                           artist_id varchar, \
                                                           year int, \
-                                                          duration float)""")
+                                                          duration float, \
+                                                          match_key varchar)""")
 
 artist_table_create = ("""CREATE TABLE IF NOT EXISTS artists (artist_id varchar PRIMARY KEY, \
                                                               artist_name varchar, \
@@ -45,6 +66,62 @@ time_table_create = ("""CREATE TABLE IF NOT EXISTS time (start_time timestamp PR
                                                          year int, \
                                                          weekday varchar)""")
 
+manifest_table_create = ("""CREATE TABLE IF NOT EXISTS ingestion_manifest (file_path varchar PRIMARY KEY, \
+                                                                          file_size bigint NOT NULL, \
+                                                                          file_mtime double precision NOT NULL, \
+                                                                          content_hash varchar NOT NULL, \
+                                                                          status varchar NOT NULL, \
+                                                                          updated_at timestamp NOT NULL DEFAULT now())""")
+
+# INDEXES
+
+# the songs columns song_select (and the song index / COPY joins) match on
+song_lookup_columns = {'songs': ('match_key', 'duration')}
+
+create_index_queries = ["CREATE INDEX IF NOT EXISTS {0}_{1}_idx ON {0} ({2})".format(table, '_'.join(columns), ', '.join(columns))
+                        for table, columns in song_lookup_columns.items()]
+
+# BULK LOAD (UNLOGGED TABLES, DEFERRED CONSTRAINTS)
+
+# the constraints of the CREATE TABLE statements above, added back after a bulk load
+table_primary_keys = {'songplays': ('songplay_id',),
+                      'users': ('user_id',),
+                      'songs': ('song_id',),
+                      'artists': ('artist_id',),
+                      'time': ('start_time',)}
+table_not_null_columns = {'songplays': ('level', 'session_id', 'location', 'user_agent'),
+                          'users': ('level',),
+                          'artists': ('artist_location', 'artist_latitude', 'artist_longitude')}
+
+# users keeps its primary key during a bulk load, the ETL upserts on it
+bulk_deferred_tables = ('songplays', 'songs', 'artists', 'time')
+
+bulk_table_persistence = ("""SELECT relname FROM pg_class \
+                             WHERE relname = ANY(%s) AND relkind = 'r' AND relpersistence = 'u';""")
+
+bulk_primary_key_check = "SELECT 1 FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'p';"
+
+# keeps the first row loaded for every key, like ON CONFLICT DO NOTHING would have
+bulk_dedupe = ("""DELETE FROM {0} a USING {0} b \
+                  WHERE ({1}) AND a.ctid > b.ctid;""")
+bulk_primary_key_add = "ALTER TABLE {} ADD PRIMARY KEY ({});"
+bulk_not_null_set = "ALTER TABLE {} ALTER COLUMN {} SET NOT NULL;"
+bulk_set_logged = "ALTER TABLE {} SET LOGGED;"
+bulk_analyze = "ANALYZE {};"
+
+# SONGPLAYS PARTITIONS
+
+songplay_partitioned_check = ("""SELECT EXISTS (SELECT 1 FROM pg_partitioned_table \
+                                                WHERE partrelid = to_regclass('songplays'));""")
+
+songplay_partition_lock = "SELECT pg_advisory_xact_lock(hashtext('songplays_partitions'));"
+
+songplay_partition_create = "CREATE TABLE IF NOT EXISTS {} PARTITION OF songplays FOR VALUES FROM (%s) TO (%s);"
+
+songplay_partition_truncate = "TRUNCATE {};"
+
+songplay_partition_exists = "SELECT to_regclass(%s) IS NOT NULL;"
+
 # INSERT RECORDS
 
 songplay_table_insert = ("""INSERT INTO songplays (songplay_id, \
@@ -72,8 +149,9 @@ song_table_insert = ("""INSERT INTO songs (song_id, \
                                            title, \
                                            artist_id, \
                                            year, \
-                                           duration)\
-                        VALUES (%s, %s, %s, %s, %s) \
+                                           duration, \
+                                           match_key)\
+                        VALUES (%s, %s, %s, %s, %s, %s) \
                         ON CONFLICT DO NOTHING;""")
 
 artist_table_insert = ("""INSERT INTO artists (artist_id, \
@@ -95,16 +173,365 @@ time_table_insert = ("""INSERT INTO time (start_time, \
                         VALUES (%s, %s, %s, %s, %s, %s, %s) \
                         ON CONFLICT DO NOTHING;""")
 
+# BATCH (MULTI-ROW) INSERT RECORDS
+
+# users rows collapsed to the latest event of each user, `level_updated_at` being its ts
+user_latest_columns = ('user_id', 'first_name', 'last_name', 'gender', 'level', 'level_updated_at')
+
+# an older event never overwrites a newer level, whatever order the files are loaded in
+user_table_upsert_latest = ("""INSERT INTO users ({}) \
+                               VALUES {} \
+                               ON CONFLICT (user_id) DO UPDATE
+                                                       SET level = EXCLUDED.level, \
+                                                           level_updated_at = EXCLUDED.level_updated_at \
+                                                       WHERE users.level_updated_at IS NULL \
+                                                          OR users.level_updated_at <= EXCLUDED.level_updated_at;""")
+
+# the single-row form is the one the prepared statement path runs
+user_table_upsert_latest_row = user_table_upsert_latest.format(', '.join(user_latest_columns),
+                                                               '({})'.format(', '.join(['%s'] * len(user_latest_columns))))
+user_table_upsert_latest = user_table_upsert_latest.format(', '.join(user_latest_columns), '%s')
+
+# match_key is computed by song_index.song_match_key when the song is loaded, not read from the file
+song_table_columns = ('song_id', 'title', 'artist_id', 'year', 'duration', 'match_key')
+artist_table_columns = ('artist_id', 'artist_name', 'artist_location', 'artist_latitude', 'artist_longitude')
+
+song_table_insert_values = ("""INSERT INTO songs ({}) \
+                               VALUES %s \
+                               ON CONFLICT DO NOTHING;""").format(', '.join(song_table_columns))
+
+artist_table_insert_values = ("""INSERT INTO artists ({}) \
+                                 VALUES %s \
+                                 ON CONFLICT DO NOTHING;""").format(', '.join(artist_table_columns))
+
 # FIND SONGS
 
-song_select = ("""SELECT songs.song_id, artists .artist_id  \
-                  FROM songs JOIN artists ON songs.artist_id = artists.artist_id
-                  WHERE songs.title=%s \
-                  AND artists.artist_name=%s \
+# songs are matched on the song-matching key of the event's title and artist name, computed by
+# song_index.song_match_key (the same function that fills songs.match_key), so that case,
+# punctuation and spacing differences between the log and song files still match
+song_select = ("""SELECT songs.song_id, songs.artist_id  \
+                  FROM songs
+                  WHERE songs.match_key=%s \
                   AND songs.duration=%s \
                   ;""")
 
+song_index_select = ("""SELECT songs.song_id, songs.match_key, songs.duration, songs.artist_id \
+                        FROM songs;""")
+
+time_select_range = ("""SELECT start_time FROM time WHERE start_time BETWEEN %s AND %s;""")
+
+# INGESTION MANIFEST
+
+manifest_select = ("""SELECT file_path, file_size, file_mtime, content_hash, status FROM ingestion_manifest;""")
+
+manifest_upsert = ("""INSERT INTO ingestion_manifest (file_path, \
+                                                      file_size, \
+                                                      file_mtime, \
+                                                      content_hash, \
+                                                      status) \
+                      VALUES (%s, %s, %s, %s, %s) \
+                      ON CONFLICT (file_path) DO UPDATE
+                                                SET file_size = EXCLUDED.file_size, \
+                                                    file_mtime = EXCLUDED.file_mtime, \
+                                                    content_hash = EXCLUDED.content_hash, \
+                                                    status = EXCLUDED.status, \
+                                                    updated_at = now();""")
+
+manifest_touch = ("""UPDATE ingestion_manifest SET file_mtime = %s, updated_at = now() WHERE file_path = %s;""")
+
+# files to load again on the next run, such as those of a reloaded month
+manifest_forget = "DELETE FROM ingestion_manifest WHERE file_path = ANY(%s);"
+
+# PREPARED STATEMENTS
+
+# server-side planning and execution time of the prepared statements, with pg_stat_statements
+# (PostgreSQL 13+, pg_stat_statements.track_planning = on for the planning time)
+prepared_statement_stats = ("""SELECT query, calls, total_plan_time, total_exec_time \
+                               FROM pg_stat_statements \
+                               WHERE query ILIKE 'PREPARE %%' \
+                               ORDER BY total_exec_time DESC;""")
+
+# PREPARE only parses, analyzes and rewrites, the plan is made by EXECUTE: the Planning Time of
+# one EXPLAIN ANALYZE of an EXECUTE is what a call of the prepared statement spends planning
+prepared_statement_explain = "EXPLAIN (ANALYZE, SUMMARY, FORMAT JSON) {}"
+
+# BULK LOAD (COPY) STAGING
+
+time_table_columns = ('start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday')
+user_table_columns = ('user_id', 'first_name', 'last_name', 'gender', 'level')
+user_staging_columns = user_latest_columns
+songplay_table_columns = ('songplay_id', 'start_time', 'user_id', 'level', 'song_id', 'artist_id',
+                          'session_id', 'location', 'user_agent')
+# the events are staged with the song-matching key of their title and artist name
+songplay_staging_columns = ('songplay_id', 'start_time', 'user_id', 'level', 'match_key', 'length',
+                            'session_id', 'location', 'user_agent')
+
+copy_staging_from_stdin = "COPY {} ({}) FROM STDIN WITH CSV"
+
+time_staging_create = ("""CREATE TEMP TABLE IF NOT EXISTS time_staging (LIKE time) \
+                          ON COMMIT DELETE ROWS""")
+
+user_staging_create = ("""CREATE TEMP TABLE IF NOT EXISTS user_staging (LIKE users) \
+                          ON COMMIT DELETE ROWS""")
+
+songplay_staging_create = ("""CREATE TEMP TABLE IF NOT EXISTS songplay_staging (songplay_id bigint, \
+                                                                            start_time timestamp, \
+                                                                            user_id int, \
+                                                                            level varchar, \
+                                                                            match_key varchar, \
+                                                                            length float, \
+                                                                            session_id int, \
+                                                                            location varchar, \
+                                                                            user_agent varchar) \
+                              ON COMMIT DELETE ROWS""")
+
+time_staging_insert = ("""INSERT INTO time ({0}) \
+                          SELECT DISTINCT ON (start_time) {0} FROM time_staging \
+                          ON CONFLICT DO NOTHING;""").format(', '.join(time_table_columns))
+
+# the latest event of each user decides the level, like user_table_upsert_latest
+user_staging_insert = ("""INSERT INTO users ({0}) \
+                          SELECT DISTINCT ON (user_id) {0} FROM user_staging \
+                          ORDER BY user_id, level_updated_at DESC \
+                          ON CONFLICT (user_id) DO UPDATE
+                                                  SET level = EXCLUDED.level, \
+                                                      level_updated_at = EXCLUDED.level_updated_at \
+                                                  WHERE users.level_updated_at IS NULL \
+                                                     OR users.level_updated_at <= EXCLUDED.level_updated_at;""").format(', '.join(user_latest_columns))
+
+songplay_staging_insert = ("""INSERT INTO songplays ({0}) \
+                              SELECT DISTINCT ON (e.songplay_id) e.songplay_id, e.start_time, e.user_id, e.level, \
+                                     s.song_id, s.artist_id, e.session_id, e.location, e.user_agent \
+                              FROM songplay_staging e \
+                              LEFT JOIN songs s \
+                                     ON s.match_key = e.match_key \
+                                    AND s.duration = e.length \
+                              ON CONFLICT DO NOTHING;""").format(', '.join(songplay_table_columns))
+
+staging_truncate = "TRUNCATE time_staging, user_staging, songplay_staging"
+
+log_tables_truncate = "TRUNCATE songplays, users, time, user_daily_plays, song_hourly_plays"
+
+# TRANSACTIONS
+
+savepoint_create = "SAVEPOINT load_file"
+savepoint_release = "RELEASE SAVEPOINT load_file"
+savepoint_rollback = "ROLLBACK TO SAVEPOINT load_file"
+
+# DICTIONARY-ENCODED SONGPLAYS
+
+# with `create_tables.py --encoded`, songplays keeps integer keys into small location and
+# user agent dictionaries instead of the strings, and the songplays view restores the
+# original columns for the queries written against them
+location_table_create = ("""CREATE TABLE IF NOT EXISTS locations (location_id serial PRIMARY KEY, \
+                                                                  location varchar NOT NULL UNIQUE)""")
+
+user_agent_table_create = ("""CREATE TABLE IF NOT EXISTS user_agents (user_agent_id serial PRIMARY KEY, \
+                                                                      user_agent varchar NOT NULL UNIQUE)""")
+
+songplay_encoded_table_create = ("""CREATE TABLE IF NOT EXISTS songplays_encoded (songplay_id bigint PRIMARY KEY, \
+                                                                                start_time timestamp, \
+                                                                                user_id int, \
+                                                                                level varchar NOT NULL, \
+                                                                                song_id varchar, \
+                                                                                artist_id varchar, \
+                                                                                session_id int NOT NULL, \
+                                                                                location_id int NOT NULL REFERENCES locations, \
+                                                                                user_agent_id int NOT NULL REFERENCES user_agents)""")
+
+songplay_view_create = ("""CREATE OR REPLACE VIEW songplays AS \
+                           SELECT e.songplay_id, e.start_time, e.user_id, e.level, e.song_id, e.artist_id, \
+                                  e.session_id, l.location, u.user_agent \
+                           FROM songplays_encoded e \
+                           JOIN locations l ON l.location_id = e.location_id \
+                           JOIN user_agents u ON u.user_agent_id = e.user_agent_id""")
+
+songplay_view_drop = "DROP VIEW IF EXISTS songplays"
+songplay_encoded_table_drop = "DROP TABLE IF EXISTS songplays_encoded"
+location_table_drop = "DROP TABLE IF EXISTS locations"
+user_agent_table_drop = "DROP TABLE IF EXISTS user_agents"
+
+songplay_encoded_check = "SELECT to_regclass('songplays_encoded') IS NOT NULL;"
+
+songplay_encoded_columns = ('songplay_id', 'start_time', 'user_id', 'level', 'song_id', 'artist_id',
+                            'session_id', 'location_id', 'user_agent_id')
+
+songplay_encoded_insert = ("""INSERT INTO songplays_encoded ({}) \
+                              VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) \
+                              ON CONFLICT DO NOTHING;""").format(', '.join(songplay_encoded_columns))
+
+# dictionary table -> (id column, value column)
+dictionary_tables = {'locations': ('location_id', 'location'),
+                     'user_agents': ('user_agent_id', 'user_agent')}
+
+dictionary_select = "SELECT {1}, {0} FROM {2};"
+
+dictionary_insert = ("""INSERT INTO {2} ({1}) SELECT unnest(%s::varchar[]) \
+                        ON CONFLICT ({1}) DO NOTHING;""")
+
+dictionary_select_values = "SELECT {1}, {0} FROM {2} WHERE {1} = ANY(%s);"
+
+# the COPY path fills the dictionaries from the staged events and joins them in
+dictionary_staging_insert = ("""INSERT INTO {2} ({1}) SELECT DISTINCT {1} FROM songplay_staging \
+                                ON CONFLICT ({1}) DO NOTHING;""")
+
+songplay_encoded_staging_insert = ("""INSERT INTO songplays_encoded ({0}) \
+                                      SELECT DISTINCT ON (e.songplay_id) e.songplay_id, e.start_time, e.user_id, e.level, \
+                                             s.song_id, s.artist_id, e.session_id, l.location_id, u.user_agent_id \
+                                      FROM songplay_staging e \
+                                      JOIN locations l ON l.location = e.location \
+                                      JOIN user_agents u ON u.user_agent = e.user_agent \
+                                      LEFT JOIN songs s \
+                                             ON s.match_key = e.match_key \
+                                            AND s.duration = e.length \
+                                      ON CONFLICT DO NOTHING;""").format(', '.join(songplay_encoded_columns))
+
+# the size of the fact table and its dictionaries, to compare with a plain songplays table
+songplay_table_sizes = ("""SELECT c.relname, pg_total_relation_size(c.oid) \
+                           FROM pg_class c \
+                           WHERE c.relname IN ('songplays', 'songplays_encoded', 'locations', 'user_agents') \
+                             AND c.relkind IN ('r', 'p');""")
+
+# ROLLUPS
+
+# plays per user per day and per song per hour, kept up to date by the ETL with the songplays
+# each file actually inserted (rollups.py), so the dashboards read a few rows by primary key
+# instead of scanning songplays. Songplays without a user or a matched song are not counted.
+user_daily_plays_table_create = ("""CREATE TABLE IF NOT EXISTS user_daily_plays (user_id int, \
+                                                                                day date, \
+                                                                                plays int NOT NULL, \
+                                                                                PRIMARY KEY (user_id, day))""")
+
+song_hourly_plays_table_create = ("""CREATE TABLE IF NOT EXISTS song_hourly_plays (song_id varchar, \
+                                                                                  hour timestamp, \
+                                                                                  plays int NOT NULL, \
+                                                                                  PRIMARY KEY (song_id, hour))""")
+
+rollup_check = "SELECT to_regclass('user_daily_plays') IS NOT NULL AND to_regclass('song_hourly_plays') IS NOT NULL;"
+
+# what the COPY path reads back from its songplays insert: the rows it actually inserted
+songplay_returning = " RETURNING songplay_id, start_time, user_id, level, song_id;"
+
+# rollup table -> (key columns, aggregate of songplays over the key columns)
+rollup_tables = {'user_daily_plays': (('user_id', 'day'),
+                                      """SELECT user_id, start_time::date AS day, count(*) AS plays \
+                                         FROM songplays WHERE user_id IS NOT NULL \
+                                         GROUP BY 1, 2"""),
+                 'song_hourly_plays': (('song_id', 'hour'),
+                                       """SELECT song_id, date_trunc('hour', start_time) AS hour, count(*) AS plays \
+                                          FROM songplays WHERE song_id IS NOT NULL \
+                                          GROUP BY 1, 2""")}
+
+# adds the plays of a batch to the rows it already has
+rollup_upsert = ("""INSERT INTO {0} ({1}, {2}, plays) VALUES %s \
+                    ON CONFLICT ({1}, {2}) DO UPDATE SET plays = {0}.plays + EXCLUDED.plays;""")
+
+rollup_truncate = "TRUNCATE {};"
+
+# the rows of one month, whose plays all come from that month's songplays
+rollup_month_delete = "DELETE FROM {0} WHERE {1} >= %s AND {1} < %s;"
+
+rollup_rebuild = "INSERT INTO {0} ({1}, {2}, plays) {3};"
+
+# the keys whose rollup row differs from the aggregate of songplays, or is missing on either side
+rollup_compare = ("""SELECT coalesce(r.{1}, f.{1}), coalesce(r.{2}, f.{2}), r.plays, f.plays \
+                     FROM {0} r \
+                     FULL JOIN ({3}) f ON r.{1} = f.{1} AND r.{2} = f.{2} \
+                     WHERE r.plays IS DISTINCT FROM f.plays \
+                     ORDER BY 1, 2;""")
+
+# the dashboard queries, answered from the rollups
+user_daily_plays_select = ("""SELECT day, plays FROM user_daily_plays \
+                              WHERE user_id = %s AND day BETWEEN %s AND %s ORDER BY day;""")
+
+song_hourly_plays_select = ("""SELECT hour, plays FROM song_hourly_plays \
+                               WHERE song_id = %s AND hour >= %s AND hour < %s ORDER BY hour;""")
+
+# LOADER STRATEGIES
+
+# table -> (columns, single-row insert) for the loader strategies of loaders.py; the VALUES and
+# COPY strategies are derived from the single-row insert
+loader_tables = {'songs': (song_table_columns, song_table_insert),
+                 'artists': (artist_table_columns, artist_table_insert),
+                 'time': (time_table_columns, time_table_insert),
+                 'users': (user_latest_columns, user_table_upsert_latest_row),
+                 'songplays': (songplay_table_columns, songplay_table_insert),
+                 'songplays_encoded': (songplay_encoded_columns, songplay_encoded_insert)}
+
+copy_text_from_stdin = "COPY {} ({}) FROM STDIN"
+
+loader_staging_create = "CREATE TEMP TABLE IF NOT EXISTS {} (LIKE {}) ON COMMIT DELETE ROWS"
+
+loader_staging_truncate = "TRUNCATE {}"
+
+loader_staging_insert = "INSERT INTO {0} ({1}) SELECT {1} FROM {2}"
+
+# SCHEMA VERSION AND RESET
+
+# create_tables.py records a hash of the statements it created the schema with, so that
+# `create_tables.py --reset` can tell whether emptying the tables gives the same schema
+schema_version_table_create = "CREATE TABLE IF NOT EXISTS schema_version (version varchar NOT NULL)"
+schema_version_table_drop = "DROP TABLE IF EXISTS schema_version"
+
+schema_version_check = "SELECT to_regclass('schema_version') IS NOT NULL;"
+schema_version_select = "SELECT version FROM schema_version;"
+schema_version_insert = "INSERT INTO schema_version (version) VALUES (%s);"
+
+database_exists = "SELECT 1 FROM pg_database WHERE datname = %s;"
+database_drop = "DROP DATABASE IF EXISTS {}"
+database_create = "CREATE DATABASE {} WITH ENCODING 'utf8' TEMPLATE {}"
+
+# every table but schema_version, referencing tables first; a single TRUNCATE of all of them
+# also satisfies the foreign keys between them (songplays_encoded -> locations, user_agents)
+reset_tables_select = ("""SELECT c.relname FROM pg_class c \
+                          JOIN pg_namespace n ON n.oid = c.relnamespace \
+                          WHERE n.nspname = 'public' AND c.relkind IN ('r', 'p') AND NOT c.relispartition \
+                            AND c.relname <> 'schema_version' \
+                          ORDER BY NOT EXISTS (SELECT 1 FROM pg_constraint f \
+                                               WHERE f.conrelid = c.oid AND f.contype = 'f'), c.relname;""")
+
+reset_truncate = "TRUNCATE {} RESTART IDENTITY;"
+
+# INDEX ADVISOR
+
+# the slowest statements the database ran, from pg_stat_statements, with $n parameters
+advisor_statement_stats = ("""SELECT query, calls, total_exec_time FROM pg_stat_statements \
+                              WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database()) \
+                                AND query ~* '^\\s*(select|with)\\M' \
+                              ORDER BY total_exec_time DESC LIMIT %s;""")
+
+server_version_select = "SELECT current_setting('server_version_num')::int;"
+
+advisor_columns_select = ("""SELECT table_name, column_name FROM information_schema.columns \
+                             WHERE table_schema = 'public' AND table_name = ANY(%s);""")
+
+# negative n_distinct is a fraction of the rows, so only small positive values are few values
+advisor_distinct_values = ("""SELECT tablename, attname, n_distinct FROM pg_stats \
+                              WHERE schemaname = 'public' AND tablename = ANY(%s);""")
+
+advisor_explain = "EXPLAIN (VERBOSE, FORMAT JSON) {}"
+advisor_explain_generic = "EXPLAIN (GENERIC_PLAN, VERBOSE, FORMAT JSON) {}"
+advisor_explain_analyze = "EXPLAIN (ANALYZE, FORMAT JSON) {}"
+
+advisor_index_size = "SELECT pg_relation_size(%s::regclass);"
+
 # QUERY LISTS
 
-create_table_queries = [songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
-drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
\ No newline at end of file
+create_table_queries = [songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create, manifest_table_create, user_daily_plays_table_create, song_hourly_plays_table_create]
+drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, manifest_table_drop, user_daily_plays_table_drop, song_hourly_plays_table_drop]
+
+def bulk_table_create(query, table):
+    """
+    Turns a CREATE TABLE statement into its bulk-load version: unlogged and, for the
+    tables in `bulk_deferred_tables`, without the primary key and NOT NULL constraints.
+    """
+    query = query.replace('CREATE TABLE', 'CREATE UNLOGGED TABLE', 1)
+    if table in bulk_deferred_tables:
+        query = query.replace(' PRIMARY KEY', '').replace(' NOT NULL', '')
+    return query
+
+
+create_table_queries_bulk = [bulk_table_create(query, table) for query, table in
+                             zip(create_table_queries, ('songplays', 'users', 'songs', 'artists', 'time'))] + \
+                            create_table_queries[5:]
+create_staging_table_queries = [time_staging_create, user_staging_create, songplay_staging_create]
\ No newline at end of file
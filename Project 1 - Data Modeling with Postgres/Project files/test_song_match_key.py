@@ -0,0 +1,58 @@
+# song_index.song_match_key is the only place the song-matching key is computed: it fills
+# songs.match_key, and song_select and the COPY path's staged events are given its value.
+# Run with `python -m pytest test_song_match_key.py`; the database check needs sparkifydb.
+import psycopg2
+import pytest
+from etl import SPARKIFY_DSN
+from song_index import song_match_key, normalize_match_text
+from sql_queries import song_table_insert, song_select
+
+AWKWARD_PAIRS = [("I Didn't Mean To", 'Casual'),
+                 ('  Hey   Jude!! ', 'The  Beatles'),
+                 ('Jóga', 'Björk'),
+                 ('東京', '宇多田ヒカル'),
+                 ('夜', '宇多田ヒカル'),
+                 ('Ночь', 'Кино'),
+                 ('snake_case (Live) [2004]', 'AC/DC'),
+                 ('', '...'),
+                 ('Track ²', 'Numbers 123')]
+
+
+@pytest.fixture(scope='module')
+def cur():
+    try:
+        conn = psycopg2.connect(SPARKIFY_DSN)
+    except psycopg2.OperationalError as e:
+        pytest.skip('sparkifydb is not available: {}'.format(e))
+    yield conn.cursor()
+    conn.rollback()
+    conn.close()
+
+
+def test_non_latin_titles_keep_their_letters():
+    assert song_match_key('東京', '宇多田ヒカル') != song_match_key('夜', '宇多田ヒカル')
+    assert song_match_key('Ночь', 'Кино') != song_match_key('', '')
+    assert song_match_key('Jóga', 'Björk') == song_match_key('JÓGA', ' björk!')
+
+
+def test_only_letters_and_decimal_digits_are_kept():
+    assert normalize_match_text('snake_case (Live) [2004]') == 'snake case live 2004'
+    assert normalize_match_text('Track ² ½ Ⅳ') == 'track'
+    assert normalize_match_text('Track²') == 'track'
+    assert normalize_match_text('١٢٣ ４５') == '١٢٣ ４５'
+
+
+def test_missing_values_have_no_key():
+    assert song_match_key(None, 'Casual') is None
+    assert song_match_key("I Didn't Mean To", float('nan')) is None
+
+
+@pytest.mark.parametrize('title, artist_name', AWKWARD_PAIRS)
+def test_song_select_finds_a_variant_of_the_loaded_song(cur, title, artist_name):
+    cur.execute('SAVEPOINT match_key_test')
+    cur.execute(song_table_insert, ('SOTESTMATCHKEY00', title, 'ARTESTMATCHKEY00', 0, 123.45,
+                                    song_match_key(title, artist_name)))
+    cur.execute(song_select, (song_match_key(' ' + title.upper() + '!', artist_name.lower()), 123.45))
+    found = cur.fetchone()
+    cur.execute('ROLLBACK TO SAVEPOINT match_key_test')
+    assert found == ('SOTESTMATCHKEY00', 'ARTESTMATCHKEY00')
@@ -0,0 +1,60 @@
+import time
+import metrics
+
+
+class CommitPolicy:
+
+    """
+    Decides when process_data commits. The transaction is committed once `every_files` files
+    or `every_rows` rows (whichever comes first) have been loaded since the last commit, and
+    the number and latency of the commits are kept for the end-of-run report.
+
+    The default of one file per commit is the behaviour process_data always had.
+
+    """
+
+    def __init__(self, conn, every_files=1, every_rows=None):
+        self.conn = conn
+        self.every_files = every_files
+        self.every_rows = every_rows
+        self.pending_files = 0
+        self.pending_rows = 0
+        self.commits = 0
+        self.commit_seconds = 0.0
+        self.max_commit_seconds = 0.0
+
+    def file_done(self, num_rows):
+        """
+        Counts a loaded (or rolled back) file and commits if a threshold is reached.
+        """
+        self.pending_files += 1
+        self.pending_rows += num_rows
+        if (self.every_files and self.pending_files >= self.every_files) or \
+           (self.every_rows and self.pending_rows >= self.every_rows):
+            self.commit()
+
+    def commit(self):
+        """
+        Commits the open transaction, if anything is pending, and records its latency.
+        """
+        if not self.pending_files:
+            return
+        start = time.perf_counter()
+        self.conn.commit()
+        seconds = time.perf_counter() - start
+        metrics.add_time('commit', seconds)
+        self.commits += 1
+        self.commit_seconds += seconds
+        self.max_commit_seconds = max(self.max_commit_seconds, seconds)
+        self.pending_files = 0
+        self.pending_rows = 0
+
+    def report(self):
+        """
+        Prints and returns the commit count and latency of the run.
+        """
+        mean = self.commit_seconds / self.commits if self.commits else 0.0
+        print('{} commits, {:.3f}s committing (mean {:.1f}ms, max {:.1f}ms)'.format(
+            self.commits, self.commit_seconds, mean * 1000, self.max_commit_seconds * 1000))
+        return {'commits': self.commits, 'commit_seconds': self.commit_seconds,
+                'mean_commit_seconds': mean, 'max_commit_seconds': self.max_commit_seconds}
@@ -112,11 +112,12 @@ song_table_create = ("""
     
     CREATE TABLE songs
     (
-        song_id             VARCHAR          NOT NULL sortkey PRIMARY KEY,
+        song_id             VARCHAR          NOT NULL PRIMARY KEY,
         song_title          VARCHAR          NOT NULL,
         artist_id           VARCHAR          NOT NULL,
         year                INTEGER          NOT NULL,
-        duration            FLOAT
+        duration            FLOAT,
+        match_key           VARCHAR(32)      NOT NULL sortkey
     
     )
     
@@ -177,6 +178,14 @@ staging_songs_copy = ("""
 
 # FINAL TABLES
 
+# The song-matching key of a title and an artist name: the md5 of both with every run of
+# characters other than letters and decimal digits (Unicode categories L and Nd, of any script) turned
+# into one space, trimmed and lowercased, like song_index.song_match_key of the Postgres project. The
+# 'p' parameter makes the pattern a PCRE one, which knows the Unicode categories.
+# It is stored in songs.match_key when the songs are loaded, and songplays join on it.
+song_match_key = ("""md5(lower(btrim(regexp_replace({0}, '[^\\\\p{{L}}\\\\p{{Nd}}]+', ' ', 1, 'p'))) || '|' ||
+                        lower(btrim(regexp_replace({1}, '[^\\\\p{{L}}\\\\p{{Nd}}]+', ' ', 1, 'p'))))""")
+
 songplay_table_insert = ("""
 
     INSERT INTO songplays (start_time,
@@ -192,16 +201,15 @@ songplay_table_insert = ("""
     SELECT          DISTINCT(timestamp 'epoch' + se.ts/1000 * interval '1 second')             AS start_time,
                     se.userId                              AS user_id,
                     se.level                               AS level, 
-                    ss.song_id                             AS song_id,
-                    ss.artist_id                           AS artist_id,
+                    s.song_id                              AS song_id,
+                    s.artist_id                            AS artist_id,
                     se.sessionId                           AS sessionId,
                     se.userAgent                           AS user_agent,
                     se.location                            AS location
-    FROM staging_songs ss 
-    JOIN staging_events se ON (ss.artist_name = se.artist_name
-                               AND ss.title = se.song)
+    FROM staging_events se 
+    JOIN songs s ON (s.match_key = {})
 
-""")
+""").format(song_match_key.format('se.song', 'se.artist_name'))
 
 ## Make sure you include the upsert
 
@@ -236,16 +244,18 @@ song_table_insert = ("""
                                 song_title,  
                                 artist_id,   
                                 year,        
-                                duration          
+                                duration,
+                                match_key
                                )
     SELECT      DISTINCT(ss.song_id)  AS song_id,
                 ss.title              AS song_title,
                 ss.artist_id          AS artist_id,
                 ss.year               AS year,
-                ss.duration           AS duration
+                ss.duration           AS duration,
+                {}                    AS match_key
     FROM staging_songs ss 
     
-""")
+""").format(song_match_key.format('ss.title', 'ss.artist_name'))
 
 artist_table_insert = ("""
 
@@ -303,7 +313,8 @@ drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songp
 
 copy_table_queries = [staging_events_copy, staging_songs_copy]
 
-insert_table_queries = [songplay_table_insert, user_table_insert, song_table_insert, artist_table_insert, time_table_insert]
+# songs are loaded first, since songplays join on their match_key
+insert_table_queries = [song_table_insert, artist_table_insert, songplay_table_insert, user_table_insert, time_table_insert]
 
 ## Collecting all the queries into one array
 row_checkers = [check_rows_songplays, check_rows_users, check_rows_songs, check_rows_artists, check_rows_time] 
@@ -6,6 +6,7 @@ from pyspark.sql.types import *
 from pyspark.sql import SparkSession
 from pyspark.sql.functions import udf, col, monotonically_increasing_id
 from pyspark.sql.functions import year, month, dayofmonth, hour, weekofyear, date_format, dayofweek
+from pyspark.sql.functions import concat, lit, lower, trim, regexp_replace, md5
 
 
 config = configparser.ConfigParser()
@@ -46,6 +47,23 @@ def getDateTime(timestamp):
     """
     return datetime.fromtimestamp(int(timestamp)/1e3)
 
+def song_match_key(title, artist_name):
+    """
+        Builds the song-matching key of a title and an artist
+        name: the md5 of both with every run of characters other
+        than letters and decimal digits of any script (Unicode
+        categories L and Nd) turned into one space, trimmed and
+        lowercased, so that case, punctuation and spacing
+        differences between the logs and the songs still match. Same key as song_index.song_match_key of
+        the Postgres project
+        
+        :param title: the title column
+        :param artist_name: the artist name column
+        :return: the match key column
+    """
+    normalized = [lower(trim(regexp_replace(column, '[^\\p{L}\\p{Nd}]+', ' '))) for column in (title, artist_name)]
+    return md5(concat(normalized[0], lit('|'), normalized[1]))
+
 def create_spark_session():
     """
         Creates the spark session with the 
@@ -88,12 +106,13 @@ def process_song_data(spark, input_data, output_data):
     # read song data file
     df_song = spark.read.csv(song_data, schema = song_schema)
 
-    # extract columns to create songs table
+    # extract columns to create songs table, with the match key the songplays join on
     songs_table = df_song.select('song_id',
                         col('title').alias('song_title'), 
                         'artist_id', 
                         'year', 
-                        'duration').dropDuplicates()
+                        'duration',
+                        song_match_key(col('title'), col('artist_name')).alias('match_key')).dropDuplicates()
     
     ## Table created user feedback
     user_feedback(songs_table, 'Created Songs Table')
@@ -196,31 +215,15 @@ def process_log_data(spark, input_data, output_data):
     ## Table created user feedback
     user_feedback(time_table, 'Created time Table')
 
-    # Path for song data
-    song_data = input_data + 'song_data/*/*/*/*.json'
-    
-    ## Defining schema once more
-    song_schema = StructType([
-        StructField("num_songs", IntegerType(), True),
-        StructField("artist_id", StringType(), False),
-        StructField("artist_latitude", DoubleType(), True),
-        StructField("artist_longitude", DoubleType(), True),
-        StructField("artist_location", StringType(), True),
-        StructField("artist_name", StringType(), True),
-        StructField("song_id", StringType(), False),
-        StructField("title", StringType(), False),
-        StructField("duration", FloatType(), True),
-        StructField("year", IntegerType(), False)
-    ])
-    
-    ## Reading data
-    df_song = spark.read.csv(song_data, schema = song_schema)
+    ## Reading the songs table written by process_song_data,
+    ## whose match key was computed when the songs were loaded
+    df_song = spark.read.parquet(output_data + 'songs/')\
+                .select('match_key', 'song_id', 'artist_id', col('year').alias('year'))
     
-    ## Renaming columns for join
-    df_song = df_song.selectExpr('title as song_title', '*')
-    df_log = df_log.selectExpr('artist as artist_name', 'song as song_title','*')
+    ## Joining on the match key of the events
+    df_log = df_log.withColumn('match_key', song_match_key(col('song'), col('artist')))
 
-    df_song_log = df_log.join(df_song, on=['song_title', 'artist_name'], how = 'outer')
+    df_song_log = df_log.join(df_song, on='match_key', how = 'outer')
     
     # extract columns from joined song and log datasets to create songplays table 
     songplays = df_song_log.select('start_time', 
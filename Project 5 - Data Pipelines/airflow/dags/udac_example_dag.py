@@ -60,7 +60,8 @@ load_songplays_table = LoadFactOperator(
     task_id='Load_songplays_fact_table',
     dag=dag,
     redshift_conn_id='redshift',
-    query = SqlQueries.songplay_table_insert
+    query = SqlQueries.songplay_table_insert,
+    table = 'songplays'
 )
 
 load_user_dimension_table = LoadDimensionOperator(
@@ -69,7 +70,7 @@ load_user_dimension_table = LoadDimensionOperator(
     redshift_conn_id='redshift',
     query = SqlQueries.user_table_insert,
     table = 'users',
-    truncate = False
+    truncate = True
 
 )
 
@@ -79,7 +80,7 @@ load_song_dimension_table = LoadDimensionOperator(
     redshift_conn_id='redshift',
     query = SqlQueries.song_table_insert,
     table = 'songs',
-    truncate = False,
+    truncate = True,
 )
 
 load_artist_dimension_table = LoadDimensionOperator(
@@ -88,7 +89,7 @@ load_artist_dimension_table = LoadDimensionOperator(
     redshift_conn_id='redshift',
     query = SqlQueries.artist_table_insert,
     table = 'artists',
-    truncate = False,
+    truncate = True,
 )
 
 load_time_dimension_table = LoadDimensionOperator(
@@ -97,7 +98,7 @@ load_time_dimension_table = LoadDimensionOperator(
     redshift_conn_id='redshift',
     query = SqlQueries.time_table_insert,
     table = 'time',
-    truncate = False,
+    truncate = True,
 )
 
 run_quality_checks = DataQualityOperator(
@@ -114,9 +115,14 @@ end_operator = DummyOperator(
 
 start_operator >> [stage_events_to_redshift, stage_songs_to_redshift]
 
-[stage_events_to_redshift, stage_songs_to_redshift] >> load_songplays_table
+# every run stages all of log_data and song_data: the dimensions are emptied and reloaded
+# from the staging tables, while songplays only appends the plays it does not have yet
+# songplays join on the match_key of the songs dimension, so it is loaded first
+stage_songs_to_redshift >> load_song_dimension_table
 
-load_songplays_table >> [load_user_dimension_table, load_song_dimension_table,
-                         load_artist_dimension_table, load_time_dimension_table] >> run_quality_checks
+[stage_events_to_redshift, load_song_dimension_table] >> load_songplays_table
+
+load_songplays_table >> [load_user_dimension_table, load_artist_dimension_table,
+                         load_time_dimension_table] >> run_quality_checks
 
 run_quality_checks >> end_operator
\ No newline at end of file
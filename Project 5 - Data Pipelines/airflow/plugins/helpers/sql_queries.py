@@ -1,23 +1,31 @@
 class SqlQueries:
+    # the song-matching key of a title and an artist name: the md5 of both with every run of
+    # characters other than letters and decimal digits (Unicode categories L and Nd, of any script) turned
+    # into one space, trimmed and lowercased, like song_index.song_match_key of the Postgres project. The
+    # 'p' parameter makes the pattern a PCRE one, which knows the Unicode categories.
+    # Stored in songs.match_key by song_table_insert, which runs before songplay_table_insert
+    song_match_key = ("""md5(lower(btrim(regexp_replace({0}, '[^\\\\p{{L}}\\\\p{{Nd}}]+', ' ', 1, 'p'))) || '|' ||
+                            lower(btrim(regexp_replace({1}, '[^\\\\p{{L}}\\\\p{{Nd}}]+', ' ', 1, 'p'))))""")
+
     songplay_table_insert = ("""
         SELECT
                 md5(events.sessionid || events.start_time) songplay_id,
                 events.start_time, 
                 events.userid, 
                 events.level, 
-                songs.song_id, 
-                songs.artist_id, 
+                songs.songid, 
+                songs.artistid, 
                 events.sessionid, 
                 events.location, 
                 events.useragent
                 FROM (SELECT TIMESTAMP 'epoch' + ts/1000 * interval '1 second' AS start_time, *
             FROM staging_events
             WHERE page='NextSong') events
-            LEFT JOIN staging_songs songs
-            ON events.song = songs.title
-                AND events.artist = songs.artist_name
+            LEFT JOIN songs
+            ON songs.match_key = {}
                 AND events.length = songs.duration
-    """)
+            WHERE md5(events.sessionid || events.start_time) NOT IN (SELECT playid FROM songplays)
+    """).format(song_match_key.format('events.song', 'events.artist'))
 
     user_table_insert = ("""
         SELECT distinct userid, firstname, lastname, gender, level
@@ -26,9 +34,9 @@ class SqlQueries:
     """)
 
     song_table_insert = ("""
-        SELECT distinct song_id, title, artist_id, year, duration
+        SELECT distinct song_id, title, artist_id, year, duration, {}
         FROM staging_songs
-    """)
+    """).format(song_match_key.format('title', 'artist_name'))
 
     artist_table_insert = ("""
         SELECT distinct artist_id, artist_name, artist_location, artist_latitude, artist_longitude
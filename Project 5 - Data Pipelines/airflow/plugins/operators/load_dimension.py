@@ -17,15 +17,16 @@ class LoadDimensionOperator(BaseOperator):
         super(LoadDimensionOperator, self).__init__(*args, **kwargs)
         self.redshift_conn_id = redshift_conn_id
         self.query = query
-        self.table = table,
+        self.table = table
         self.truncate = truncate
 
     def execute(self, context):
         """
-        Inserting data into the various dimension tables
+        Inserting data into the various dimension tables, the query
+        being the SELECT of the rows to insert into self.table
 
         """
         redshift_hook = PostgresHook(self.redshift_conn_id)
         if self.truncate:
             redshift_hook.run(f"TRUNCATE TABLE {self.table}")
-        redshift_hook.run(str(self.query))
+        redshift_hook.run(f"INSERT INTO {self.table} {self.query}")
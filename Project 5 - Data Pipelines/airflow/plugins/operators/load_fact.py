@@ -10,16 +10,19 @@ class LoadFactOperator(BaseOperator):
     def __init__(self,
                  redshift_conn_id="",
                  query = '',
+                 table = '',
                  *args, **kwargs):
 
         super(LoadFactOperator, self).__init__(*args, **kwargs)
         self.redshift_conn_id = redshift_conn_id
         self.query = query
+        self.table = table
 
     def execute(self, context):
         """
-        Inserting data into the facts table from the staging tables
+        Inserting data into the facts table from the staging tables,
+        the query being the SELECT of the rows to append to self.table
 
         """
         redshift_hook = PostgresHook(self.redshift_conn_id)
-        redshift_hook.run(str(self.query))
+        redshift_hook.run(f"INSERT INTO {self.table} {self.query}")
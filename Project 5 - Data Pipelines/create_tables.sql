@@ -25,6 +25,7 @@ CREATE TABLE public.songs (
 	artistid varchar(256),
 	"year" int4,
 	duration numeric(18,0),
+	match_key varchar(32) SORTKEY,
 	CONSTRAINT songs_pkey PRIMARY KEY (songid)
 );
 